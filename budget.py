@@ -0,0 +1,160 @@
+import threading
+from usage import extract_token_usage
+
+# USD per 1M tokens: (input, cached input, output)
+PRICING = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+}
+
+_encodings = {}
+
+
+def count_tokens(text, model='gpt-4o-mini'):
+    """Count tokens with tiktoken, or approximate at 4 characters per token without it"""
+    if model not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding('o200k_base')
+        except Exception:
+            # tiktoken missing, or its encoding files cannot be downloaded
+            _encodings[model] = None
+    if _encodings[model] is None:
+        return max(1, len(str(text)) // 4)
+    return len(_encodings[model].encode(str(text)))
+
+
+class Budget:
+    """Run-level spending limit in tokens and/or dollars
+
+    Every model call is charged against the budget. As the spent fraction
+    grows, plan() returns progressively cheaper settings: fewer attempts,
+    fewer examples and less recent context, then a single shallow attempt
+    with no arbitration. Once the budget is used up no more calls are made.
+    """
+
+    # (spent fraction, attempts cap, examples, context window, depth cap, arbitrate)
+    STAGES = [
+        (0.0, None, 5, None, None, True),
+        (0.5, 2, 3, None, None, True),
+        (0.75, 1, 2, 1, None, False),
+        (0.9, 1, 0, 0, 3, False),
+    ]
+
+    def __init__(self, max_tokens=None, max_usd=None, model='gpt-4o-mini'):
+        if max_tokens is None and max_usd is None:
+            raise ValueError("Set max_tokens, max_usd or both")
+        self.max_tokens = max_tokens
+        self.max_usd = max_usd
+        self.model = model
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.usd = 0.0
+
+    def cost(self, prompt_tokens, cached_tokens, completion_tokens, model=None):
+        input_price, cached_price, output_price = PRICING.get(model or self.model, PRICING['gpt-4o-mini'])
+        return ((prompt_tokens - cached_tokens) * input_price
+                + cached_tokens * cached_price
+                + completion_tokens * output_price) / 1_000_000
+
+    def charge(self, response, prompt, model=None):
+        """Charge one call at `model`'s prices, estimating tokens if the backend did not report usage"""
+        prompt_tokens, cached_tokens, completion_tokens = extract_token_usage(response)
+        if not prompt_tokens:
+            prompt_tokens = count_tokens(prompt, self.model)
+            completion_tokens = max(completion_tokens, 1)
+        with self.lock:
+            self.tokens += prompt_tokens + completion_tokens
+            self.usd += self.cost(prompt_tokens, cached_tokens, completion_tokens, model)
+
+    def spent_fraction(self):
+        with self.lock:
+            fractions = []
+            if self.max_tokens is not None:
+                fractions.append(self.tokens / self.max_tokens)
+            if self.max_usd is not None:
+                fractions.append(self.usd / self.max_usd)
+        return max(fractions)
+
+    def exhausted(self):
+        return self.spent_fraction() >= 1.0
+
+    def plan(self, num_attempts, max_depth, context_window=None):
+        """Settings to use for the next item given how much has been spent"""
+        spent = self.spent_fraction()
+        if spent >= 1.0:
+            return {'exhausted': True}
+        for threshold, attempts_cap, examples, window_cap, depth_cap, arbitrate in self.STAGES:
+            if spent >= threshold:
+                stage = (attempts_cap, examples, window_cap, depth_cap, arbitrate)
+        attempts_cap, examples, window_cap, depth_cap, arbitrate = stage
+        return {
+            'exhausted': False,
+            'num_attempts': min(num_attempts, attempts_cap) if attempts_cap else num_attempts,
+            'max_depth': min(max_depth, depth_cap) if depth_cap else max_depth,
+            'max_examples': examples,
+            'context_window': context_window if window_cap is None else min(context_window or 0, window_cap),
+            'arbitrate': arbitrate,
+        }
+
+    def summary(self):
+        with self.lock:
+            parts = [f"{self.tokens} tokens"]
+            if self.max_tokens is not None:
+                parts[0] += f" of {self.max_tokens}"
+            parts.append(f"${self.usd:.4f}" + (f" of ${self.max_usd:.2f}" if self.max_usd is not None else ""))
+        return "Budget used: " + ", ".join(parts)
+
+
+def estimate_item_tokens(conn, num_attempts=3, max_depth=4, context_window=3, model='gpt-4o-mini'):
+    """Upper-bound prompt tokens and calls to classify one item with the full tree walk
+
+    Uses the average prompt size over all nodes at each level, plus one
+    arbitration call when more than one attempt is made.
+    """
+    from classifier import create_gpt_prompt, get_options_for_level, get_examples_for_level
+
+    cursor = conn.cursor()
+    context = [{'description': 'x' * 60, 'code': '000.00', 'sitc_description': 'x' * 60}] * context_window
+    walk_tokens = 0
+    for level in range(1, max_depth + 1):
+        if level == 1:
+            parents = [None]
+        else:
+            cursor.execute("SELECT code FROM sitc_codes WHERE level = ?", (level - 1,))
+            parents = [row[0] for row in cursor.fetchall()]
+        sizes = []
+        for parent in parents:
+            options = get_options_for_level(cursor, level, parent)
+            if not options:
+                continue
+            examples = get_examples_for_level(cursor, level, parent)
+            prompt, _ = create_gpt_prompt('x' * 60, options, examples, recent_classifications=context)
+            sizes.append(count_tokens(prompt, model))
+        if sizes:
+            walk_tokens += sum(sizes) / len(sizes)
+
+    calls = num_attempts * max_depth + (1 if num_attempts > 1 else 0)
+    tokens = walk_tokens * num_attempts + (200 if num_attempts > 1 else 0) + calls
+    return int(tokens), calls
+
+
+def print_cost_projection(conn, rows, num_attempts=3, max_depth=4, budget=None, model='gpt-4o-mini'):
+    """Print the projected worst-case spend for a run of `rows` items"""
+    item_tokens, item_calls = estimate_item_tokens(conn, num_attempts, max_depth, model=model)
+    input_price, _, output_price = PRICING.get(model, PRICING['gpt-4o-mini'])
+    tokens = item_tokens * rows
+    usd = (tokens * input_price + item_calls * rows * output_price) / 1_000_000
+    print(f"Projected cost for {rows} rows: up to {item_calls * rows} LLM calls, "
+          f"~{tokens:,} tokens, ~${usd:.2f} ({model}, before prompt caching and known matches)")
+    if budget is not None:
+        limits = []
+        if budget.max_tokens is not None:
+            limits.append(f"{budget.max_tokens:,} tokens")
+        if budget.max_usd is not None:
+            limits.append(f"${budget.max_usd:.2f}")
+        print(f"Budget: {' / '.join(limits)}; settings will be scaled down as it is spent")
+    return tokens, usd
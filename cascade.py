@@ -0,0 +1,177 @@
+import os
+import re
+import math
+import heapq
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from training_store import determine_sitc_level, code_at_level, _database_key
+
+
+def _tokens(text):
+    """Lower-cased words of 3+ characters with accents removed"""
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r'[a-z0-9]{3,}', text)
+
+
+class LexicalScorer:
+    """TF-IDF nearest-neighbour scorer over the training examples
+
+    A description is compared with every training example sharing a word with
+    it. The k most similar examples vote for their codes (truncated to
+    max_depth), weighted by similarity. Confidence is the winning code's best
+    similarity times its share of the vote, so it is high only when a close
+    example exists and the neighbours agree.
+
+    Examples added after loading are scored with the IDF weights of the time
+    they were added; earlier examples keep theirs until the scorer is rebuilt.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+        self.idf = {}
+        self.document_counts = Counter()
+        self.postings = defaultdict(list)
+        self.codes = []
+
+    def _weights(self, tokens):
+        weights = {token: (1 + math.log(count)) * self.idf[token]
+                   for token, count in Counter(tokens).items() if token in self.idf}
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        return {token: weight / norm for token, weight in weights.items()} if norm else {}
+
+    def _idf(self, token):
+        return math.log((len(self.codes) + 1) / (self.document_counts[token] + 1)) + 1
+
+    def _index(self, tokens, code):
+        for token, weight in self._weights(tokens).items():
+            self.postings[token].append((len(self.codes), weight))
+        self.codes.append(code)
+
+    def load(self, conn):
+        # Examples whose code is missing from sitc_codes could not be described when accepted
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT t.description, t.sitc_code
+            FROM training_examples t
+            JOIN sitc_codes s ON s.code = t.sitc_code
+            ORDER BY t.rowid
+        """)
+        rows = cursor.fetchall()
+        documents = [_tokens(description) for description, _ in rows]
+        self.document_counts = Counter(token for tokens in documents for token in set(tokens))
+        self.idf = {token: math.log((len(rows) + 1) / (count + 1)) + 1 for token, count in self.document_counts.items()}
+        for tokens, (_, code) in zip(documents, rows):
+            self._index(tokens, code)
+        return self
+
+    def add(self, description, code):
+        """Index one new example; words not seen before get an IDF weight from the current counts"""
+        tokens = _tokens(description)
+        self.document_counts.update(set(tokens))
+        for token in set(tokens):
+            if token not in self.idf:
+                self.idf[token] = self._idf(token)
+        self._index(tokens, code)
+
+    def score(self, description, max_depth):
+        """Return (code, confidence) for the best-supported code, or None if nothing is similar"""
+        similarities = defaultdict(float)
+        for token, weight in self._weights(_tokens(description)).items():
+            for example, example_weight in self.postings[token]:
+                similarities[example] += weight * example_weight
+        if not similarities:
+            return None
+
+        votes = defaultdict(float)
+        best = defaultdict(float)
+        for example, similarity in heapq.nlargest(self.k, similarities.items(), key=lambda item: item[1]):
+            code = self.codes[example]
+            if determine_sitc_level(code) > max_depth:
+                code = code_at_level(code, max_depth)
+            votes[code] += similarity
+            best[code] = max(best[code], similarity)
+
+        code = max(votes, key=votes.get)
+        return code, best[code] * votes[code] / sum(votes.values())
+
+
+_scorers = {}
+_scorers_lock = threading.Lock()
+
+
+def get_lexical_scorer(conn, k=5):
+    """Return the lexical scorer for this connection's database, building it on first use"""
+    key = (_database_key(conn), k)
+    with _scorers_lock:
+        if key not in _scorers:
+            _scorers[key] = LexicalScorer(k).load(conn)
+        return _scorers[key]
+
+
+def add_to_lexical_scorers(conn, description, code):
+    """Add a new example to the scorers already built for this connection's database"""
+    database = _database_key(conn)
+    with _scorers_lock:
+        for (key, _), scorer in _scorers.items():
+            if key == database:
+                scorer.add(description, code)
+
+
+def chat_model(name, timeout=None):
+    """Create an OpenAI chat model with the classifier's settings
+
+    With a timeout (seconds), requests running longer are aborted by the
+    client and not retried, leaving the retry to the classifier.
+    """
+    from langchain_openai import ChatOpenAI
+    if timeout is None:
+        return ChatOpenAI(model=name, temperature=0, api_key=os.getenv('OPENAI_API_KEY'))
+    return ChatOpenAI(model=name, temperature=0, api_key=os.getenv('OPENAI_API_KEY'), timeout=timeout, max_retries=0)
+
+
+class Cascade:
+    """Tiered classification: local scorer, then the default model, then a stronger model
+
+    1. The lexical scorer answers items it scores at `accept_confidence` or above.
+    2. Otherwise the default model makes its first attempt. If that agrees with
+       the scorer's guess down to `agree_level`, it is accepted as is.
+    3. Otherwise the remaining attempts run and `strong_llm` makes the final
+       decision between them, in place of the default model's arbitration.
+
+    Pass accept_confidence=None to skip tier 1 and strong_llm=None to
+    arbitrate with the default model. Counts per tier are kept in `tiers`.
+    """
+
+    def __init__(self, strong_llm=None, accept_confidence=0.6, agree_level=3, k=5):
+        self.strong_llm = strong_llm
+        self.accept_confidence = accept_confidence
+        self.agree_level = agree_level
+        self.k = k
+        self.lock = threading.Lock()
+        self.tiers = Counter()
+
+    def score(self, conn, description, max_depth):
+        """The scorer's (code, confidence) guess, or None"""
+        return get_lexical_scorer(conn, self.k).score(description, max_depth)
+
+    def accepts(self, guess):
+        return (guess is not None and self.accept_confidence is not None
+                and guess[1] >= self.accept_confidence)
+
+    def agrees(self, guess, code):
+        """True if the model's code and the scorer's guess share the same ancestor at agree_level"""
+        if guess is None:
+            return False
+        level = min(self.agree_level, determine_sitc_level(code), determine_sitc_level(guess[0]))
+        return code_at_level(code, level) == code_at_level(guess[0], level)
+
+    def record(self, tier):
+        with self.lock:
+            self.tiers[tier] += 1
+
+    def summary(self):
+        with self.lock:
+            return (f"Cascade: {self.tiers['lexical']} items answered by the lexical scorer, "
+                    f"{self.tiers['small']} by the default model, {self.tiers['strong']} escalated to the strong model")
@@ -4,8 +4,16 @@ from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 import string
+import json
+import time
 from collections import Counter
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from training_store import get_example_index, determine_sitc_level, code_at_level
+from usage import UsageStats
+from rules import match_rule
+from profiling import stage, timed
 
 # Load environment variables and initialize LangChain
 load_dotenv()
@@ -15,6 +23,46 @@ llm = ChatOpenAI(
     api_key=os.getenv('OPENAI_API_KEY')
 )
 
+# Answer instructions for answer_mode="json", where replies are constrained to the listed codes
+JSON_ANSWER_RULE = ('2. Respond with ONLY a JSON object of the form {"code": "<code>"}, using one of the listed codes.\n'
+                    'Do not include any explanations or the category description.')
+JSON_ANSWER_REMINDER = 'Answer with a JSON object {"code": "<code>"} using one of the listed codes.'
+
+class PartialResult(tuple):
+    """A (code, description) pair from a walk that its deadline cut short"""
+    partial = True
+
+# Token totals for every call made through invoke_llm, including cached prompt tokens
+usage_stats = UsageStats()
+# The part of usage_stats spent re-classifying shard warm-up items
+warmup_usage_stats = UsageStats()
+_warmup = threading.local()
+
+def set_llm(backend):
+    """Replace the chat model used for all classification calls (e.g. with a local stand-in)"""
+    global llm
+    llm = backend
+
+def get_llm():
+    """Return the chat model currently used for classification calls"""
+    return llm
+
+def invoke_llm(prompt, budget=None, backend=None, **call_options):
+    """Send a prompt to the current model (or `backend`) and record its token usage
+
+    Extra keyword arguments (e.g. response_format) are passed on to invoke.
+    """
+    backend = backend or llm
+    with stage("llm"):
+        response = backend.invoke(prompt, **call_options)
+    usage_stats.record(response)
+    if getattr(_warmup, 'active', False):
+        warmup_usage_stats.record(response)
+    if budget is not None:
+        budget.charge(response, prompt, getattr(backend, 'model_name', None))
+    return response
+
+@timed("sqlite")
 def is_terminal_code(cursor, code):
     """Check if a code has no deeper children"""
     cursor.execute("""
@@ -26,6 +74,7 @@ def is_terminal_code(cursor, code):
 
 
 
+@timed("sqlite")
 def get_options_for_level(cursor, level, parent_code=None):
     """Get available SITC codes for the current level (removing 4-digit limitation)"""
     if parent_code:
@@ -44,69 +93,110 @@ def get_options_for_level(cursor, level, parent_code=None):
         """, (level,))
     return cursor.fetchall()
 
-def get_examples_for_level(cursor, level, parent_code=None):
+@timed("sqlite")
+def get_examples_for_level(cursor, level, parent_code=None, limit=5):
     """Get training examples for a specific level/parent code"""
+    if limit <= 0:
+        return []
     if parent_code:
         cursor.execute("""
             SELECT t.description, t.sitc_code, s.description
             FROM training_examples t
             JOIN sitc_codes s ON t.sitc_code = s.code
             WHERE t.level = ? AND t.sitc_code LIKE ? || '%'
-            LIMIT 5
-        """, (level, parent_code))
+            LIMIT ?
+        """, (level, parent_code, limit))
     else:
         cursor.execute("""
             SELECT t.description, t.sitc_code, s.description
             FROM training_examples t
             JOIN sitc_codes s ON t.sitc_code = s.code
             WHERE t.level = ?
-            LIMIT 5
-        """, (level,))
+            LIMIT ?
+        """, (level, limit))
     return cursor.fetchall()
 
-def create_gpt_prompt(description, options, examples, previous_classifications=None, excluded_options=None, recent_classifications=None):
-    """Create a prompt for GPT classification with context from recent classifications"""
-    template = """You are a trade classification expert. Your task is to classify the following Spanish description into the most appropriate SITC category at the current level:
+def filter_excluded_options(options, excluded_options=None):
+    """Drop options under previously chosen codes, keeping all of them if none would remain"""
+    available_options = []
+    for code, desc in options:
+        if excluded_options and any(code.startswith(excluded) for excluded in excluded_options):
+            continue
+        available_options.append((code, desc))
 
-Description to classify: {description}
+    if not available_options:
+        # If all options were excluded, use original options (failsafe)
+        available_options = options
+    return available_options
+
+@timed("sqlite")
+def get_code_path(cursor, code):
+    """Get (code, description) for every level from the top down to `code`, or None if unknown"""
+    path = []
+    for level in range(1, determine_sitc_level(code) + 1):
+        ancestor = code_at_level(code, level)
+        cursor.execute("SELECT description FROM sitc_codes WHERE code = ?", (ancestor,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        path.append((ancestor, row[0]))
+    return path
+
+@timed("prompt")
+def create_gpt_prompt(description, options, examples, previous_classifications=None, excluded_options=None, recent_classifications=None,
+                      answer_mode="letter"):
+    """Create a prompt for GPT classification with context from recent classifications
+
+    In "letter" mode the options are lettered and option_map maps letters to
+    option indexes; in "json" mode they are listed by code, the model answers
+    {"code": ...} and option_map maps codes to option indexes.
+    """
+    # Content that is the same for every item at a node (instructions, path,
+    # options, examples) comes first so the provider can cache the prompt
+    # prefix; per-item content (recent context, description) comes last.
+    template = """You are a trade classification expert. Your task is to classify a Spanish description into the most appropriate SITC category at the current level.
 
-{recent_context}
+IMPORTANT:
+1. Items that appear close to each other in the list often have similar classifications, especially in their first two digits.
+{answer_rule}
+
+{previous_section}
 
 Available options:
 {formatted_options}
 
 {examples_section}
 
-{previous_section}
-
 {attempt_guidance}
 
-IMPORTANT:
-1. Items that appear close to each other in the list often have similar classifications, especially in their first two digits.
-2. Respond with ONLY a single letter from A-{last_letter}.
-Do not include any explanations, colons, periods, or the category description."""
+{recent_context}
+
+Description to classify: {description}
+
+{answer_reminder}"""
 
     letters = list(string.ascii_uppercase)
     option_map = {}
     formatted_options = ""
 
-    # Filter out excluded options more strictly
-    available_options = []
-    for code, desc in options:
-        if excluded_options and any(code.startswith(excluded) for excluded in excluded_options):
-            continue
-        available_options.append((code, desc))
+    available_options = filter_excluded_options(options, excluded_options)
 
-    if not available_options:
-        # If all options were excluded, use original options (failsafe)
-        available_options = options
-
-    for i, (code, desc) in enumerate(available_options):
-        if i >= len(letters):
-            break
-        letter = letters[i]
-        formatted_options += f"{letter}. {code}: {desc}\n"
-        option_map[letter] = i
+    if answer_mode == "json":
+        for i, (code, desc) in enumerate(available_options):
+            formatted_options += f"- {code}: {desc}\n"
+            option_map[code] = i
+        answer_rule = JSON_ANSWER_RULE
+        answer_reminder = JSON_ANSWER_REMINDER
+    else:
+        for i, (code, desc) in enumerate(available_options):
+            if i >= len(letters):
+                break
+            letter = letters[i]
+            formatted_options += f"{letter}. {code}: {desc}\n"
+            option_map[letter] = i
+        answer_rule = ("2. Respond with ONLY a single letter from the available options.\n"
+                       "Do not include any explanations, colons, periods, or the category description.")
+        answer_reminder = f"Answer with a single letter from A-{letters[min(len(available_options)-1, len(letters)-1)]}."
 
     # Format recent classifications context
     recent_context = ""
@@ -140,13 +230,114 @@ Do not include any explanations, colons, periods, or the category description.""
         examples_section=examples_section,
         previous_section=previous_section,
         attempt_guidance=attempt_guidance,
-        last_letter=letters[min(len(available_options)-1, len(letters)-1)],
+        answer_rule=answer_rule,
+        answer_reminder=answer_reminder,
         recent_context=recent_context
     )
 
     return formatted_prompt, option_map
 
 
+@timed("sqlite")
+def get_subtree(cursor, parent_code, max_depth, limit=None):
+    """Get the codes below parent_code down to max_depth, in tree order"""
+    cursor.execute("""
+        SELECT code, description, level
+        FROM sitc_codes
+        WHERE code LIKE ? || '%' AND code != ? AND level <= ?
+        ORDER BY code
+        LIMIT ?
+    """, (parent_code or '', parent_code or '', max_depth, -1 if limit is None else limit))
+    return cursor.fetchall()
+
+@timed("prompt")
+def create_flattened_prompt(description, subtree, examples, previous_classifications=None, excluded_options=None, recent_classifications=None,
+                            answer_mode="letter"):
+    """Create a prompt that shows a whole subtree and asks for the most specific code directly
+
+    Outside "json" mode the answer is the bare code; there are no letters here.
+    """
+    template = """You are a trade classification expert. Your task is to classify a Spanish description into the most specific SITC category that fits it.
+
+IMPORTANT:
+1. Items that appear close to each other in the list often have similar classifications, especially in their first two digits.
+{answer_rule}
+
+{previous_section}
+
+Available categories (indented under their parent category, selectable codes marked with *):
+{formatted_options}
+
+{examples_section}
+
+{attempt_guidance}
+
+{recent_context}
+
+Description to classify: {description}
+
+{answer_reminder}"""
+
+    # A node is selectable if nothing else in the subtree sits below it
+    parents = {code_at_level(code, level - 1) for code, _, level in subtree}
+    leaves = [code for code, _, _ in subtree if code not in parents]
+
+    selectable = [code for code in leaves
+                  if not (excluded_options and any(code.startswith(excluded) for excluded in excluded_options))]
+    if not selectable:
+        # If all leaves were excluded, offer all of them again (failsafe)
+        selectable = leaves
+
+    base_level = subtree[0][2]
+    formatted_options = ""
+    allowed_codes = {}
+    for code, desc, level in subtree:
+        indent = "  " * (level - base_level)
+        if code in selectable:
+            formatted_options += f"{indent}* {code}: {desc}\n"
+            allowed_codes[code] = desc
+        else:
+            formatted_options += f"{indent}{code}: {desc}\n"
+
+    recent_context = ""
+    if recent_classifications:
+        recent_context = "Recent classifications from the same list:\n"
+        for rc in recent_classifications:
+            recent_context += f"- '{rc['description']}' was classified as {rc['code']}: {rc['sitc_description']}\n"
+        recent_context += "\nNote: Items in the same list often have similar classifications, especially in their first two digits.\n"
+
+    examples_section = ""
+    if examples:
+        examples_section = "Here are some examples of previous classifications:\n"
+        for ex_desc, ex_code, ex_sitc_desc in examples:
+            examples_section += f"- '{ex_desc}' was classified as {ex_code}: {ex_sitc_desc}\n"
+
+    previous_section = ""
+    if previous_classifications:
+        previous_section = "Your classification path so far:\n"
+        for level, (code, desc) in enumerate(previous_classifications, 1):
+            previous_section += f"Level {level}: {code}: {desc}\n"
+
+    attempt_guidance = ""
+    if excluded_options:
+        attempt_guidance = "Since some options were previously selected, please choose your next best classification from the remaining options."
+
+    prompt = ChatPromptTemplate.from_template(template)
+    formatted_prompt = prompt.format(
+        description=description,
+        formatted_options=formatted_options,
+        examples_section=examples_section,
+        previous_section=previous_section,
+        attempt_guidance=attempt_guidance,
+        answer_rule=JSON_ANSWER_RULE if answer_mode == "json" else
+            "2. Respond with ONLY one of the codes marked with *.\nDo not include any explanations or the category description.",
+        answer_reminder=JSON_ANSWER_REMINDER if answer_mode == "json" else "Answer with a single code marked with *.",
+        recent_context=recent_context
+    )
+
+    return formatted_prompt, allowed_codes
+
+
 def clean_gpt_response(response):
     """Clean GPT response to get only the letter"""
     cleaned = re.sub(r'[^A-Za-z]', '', response).upper()
@@ -154,11 +345,106 @@ def clean_gpt_response(response):
         return cleaned[0]  # Return only the first letter to avoid multiple letters
     return ""
 
+def clean_code_response(response, allowed_codes):
+    """Return the first allowed code mentioned in a response"""
+    for candidate in re.findall(r'\d+(?:\.\d+)?', response):
+        if candidate in allowed_codes:
+            return candidate
+    return ""
+
+def parse_letter_answer(response, option_map):
+    """Return the option letter a response starts with, or "" if it is not a valid option
+
+    Unlike clean_gpt_response, a verbose reply such as "The answer is B" is
+    rejected rather than read as "T".
+    """
+    match = re.match(r"[\s*_`'\"(]*([A-Za-z])(?![A-Za-z])", response)
+    if match and match.group(1).upper() in option_map:
+        return match.group(1).upper()
+    return ""
+
+def parse_code_answer(response, allowed_codes):
+    """Return the code from a {"code": ...} reply, or "" if it is not an allowed code"""
+    try:
+        code = str(json.loads(response).get("code", "")).strip()
+    except (ValueError, AttributeError):
+        # Not a JSON object, but the reply may still name an allowed code
+        return clean_code_response(response, allowed_codes)
+    return code if code in allowed_codes else ""
+
+def code_response_format(codes):
+    """OpenAI response_format restricting the reply to {"code": <one of codes>}"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "sitc_code",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"code": {"type": "string", "enum": list(codes)}},
+                "required": ["code"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def ask_model(prompt, parse, valid_answers, budget=None, max_reasks=1, answer_mode="letter", backend=None,
+              expires=None):
+    """Invoke the model and parse its answer, re-asking when the answer is invalid
+
+    The re-ask repeats the prompt with the rejected answer and the list of
+    valid answers, instead of abandoning the attempt. A call that times out
+    is retried as is and counts as one of the re-asks. No re-ask is sent
+    after the time.monotonic() deadline `expires` or once the budget is
+    exhausted. Returns "" if no valid answer was given, or None if the
+    deadline or budget stopped the re-asks (see stop_reason).
+    """
+    call_options = {}
+    if answer_mode == "json":
+        call_options["response_format"] = code_response_format(valid_answers)
+
+    request = prompt
+    for ask in range(max_reasks + 1):
+        if ask and stop_reason(budget, expires):
+            return None
+        try:
+            response = invoke_llm(request, budget, backend, **call_options)
+        except TimeoutError as e:
+            print(f"{e}, retrying")
+            continue
+        answer = parse(response.content)
+        if answer:
+            return answer
+        print(f"Invalid answer {response.content!r}, expected one of: {', '.join(valid_answers)}")
+        request = (f"{prompt}\n\nYour previous answer {response.content.strip()!r} is not one of the allowed answers. "
+                   f"Reply again with exactly one of: {', '.join(valid_answers)}.")
+    return ""
+
+def stop_reason(budget, expires):
+    """Why no further model call may start ("Budget exhausted" or "Deadline expired"), or None"""
+    if budget is not None and budget.exhausted():
+        return "Budget exhausted"
+    if expires is not None and time.monotonic() >= expires:
+        return "Deadline expired"
+    return None
+
+def deepest_partial_result(full_attempts, reason="Deadline expired"):
+    """Anytime result for a walk cut short: the deepest code reached, ties going to the earliest attempt"""
+    if not full_attempts:
+        print(f"{reason} before any code was chosen")
+        return PartialResult(("IDK", reason))
+    deepest = max(full_attempts, key=lambda attempt: determine_sitc_level(attempt[0]))
+    print(f"{reason}, partial result: {deepest[0]} - {deepest[1]}")
+    return PartialResult(deepest)
+
 def clean_code_for_level(code):
     """Remove periods from code and return the length as the level"""
     return code.replace('.', '')
 
-def classify_description(description, conn, num_attempts=3, max_depth=4, recent_classifications=None):
+@timed("classify_item")
+def classify_description(description, conn, num_attempts=3, max_depth=4, recent_classifications=None, use_known_matches=True,
+                         budget=None, flatten_threshold=None, rules=None, max_examples=5, answer_mode="letter",
+                         max_reasks=1, cascade=None, deadline=None):
     cursor = conn.cursor()
     full_attempts = []
     first_attempt_codes = set()  # Store ALL codes from first attempt's path
@@ -166,6 +452,65 @@ def classify_description(description, conn, num_attempts=3, max_depth=4, recent_
 
     print(f"\nClassifying: {description}")
 
+    # With a deadline (seconds), no new model call starts once it has passed
+    expires = time.monotonic() + deadline if deadline is not None else None
+    cut_short = None  # Set to the stop_reason when the deadline or budget ends a walk early
+
+    # Descriptions that were already verified skip the LLM walk entirely
+    if use_known_matches:
+        with stage("known_matches"):
+            known = get_example_index(conn).lookup(description)
+        if known:
+            code, desc = known
+            if determine_sitc_level(code) > max_depth:
+                code = code_at_level(code, max_depth)
+                cursor.execute("SELECT description FROM sitc_codes WHERE code = ?", (code,))
+                desc = cursor.fetchone()[0]
+            print(f"Known example: {code} - {desc}")
+            return code, desc
+
+    # A matching user rule pins the start of the path before any model call
+    pinned_path = []
+    rule = match_rule(description, rules)
+    if rule:
+        pinned_path = get_code_path(cursor, rule.code) or []
+        if not pinned_path:
+            print(f"Ignoring {rule}: unknown SITC code")
+        elif len(pinned_path) >= max_depth or is_terminal_code(cursor, rule.code):
+            code, desc = pinned_path[min(len(pinned_path), max_depth) - 1]
+            print(f"Matched {rule}: {code} - {desc}")
+            return code, desc
+        else:
+            print(f"Matched {rule}: starting below {rule.code}")
+
+    # The cascade's local scorer answers confident items without any model call
+    lexical_guess = None
+    if cascade is not None:
+        with stage("lexical"):
+            lexical_guess = cascade.score(conn, description, max_depth)
+        if cascade.accepts(lexical_guess):
+            code = lexical_guess[0]
+            cursor.execute("SELECT description FROM sitc_codes WHERE code = ?", (code,))
+            row = cursor.fetchone()
+            if row is not None:
+                cascade.record("lexical")
+                print(f"Lexical match ({lexical_guess[1]:.2f}): {code} - {row[0]}")
+                return code, row[0]
+
+    # Scale the walk down as the run's budget is spent
+    arbitrate = True
+    if budget is not None:
+        plan = budget.plan(num_attempts, max_depth, len(recent_classifications or []))
+        if plan['exhausted']:
+            print("Budget exhausted, not classifying")
+            return "IDK", "Budget exhausted"
+        num_attempts = plan['num_attempts']
+        max_depth = plan['max_depth']
+        max_examples = min(max_examples, plan['max_examples'])
+        arbitrate = plan['arbitrate']
+        if recent_classifications and plan['context_window'] is not None:
+            recent_classifications = recent_classifications[len(recent_classifications) - plan['context_window']:]
+
     # If we have recent classifications, print them for debugging
     if recent_classifications:
         print("\nRecent classifications:")
@@ -173,9 +518,15 @@ def classify_description(description, conn, num_attempts=3, max_depth=4, recent_
             print(f"- {rc['description']}: {rc['code']}")
 
     for attempt_num in range(num_attempts):
-        current_level = 1
-        history = []
-        attempt_path = []
+        if expires is not None and time.monotonic() >= expires:
+            cut_short = "Deadline expired"
+            break
+        if budget is not None and budget.exhausted():
+            # No walk was cut; the attempts made so far are complete
+            break
+        current_level = len(pinned_path) + 1
+        history = list(pinned_path)
+        attempt_path = list(pinned_path)
 
         try:
             max_iterations = 10
@@ -185,61 +536,127 @@ def classify_description(description, conn, num_attempts=3, max_depth=4, recent_
                 iteration += 1
 
                 parent_code = history[-1][0] if history else None
-                options = get_options_for_level(cursor, current_level, parent_code)
-
-                if not options:
-                    break
-
-                examples = get_examples_for_level(cursor, current_level, parent_code)
 
                 # For subsequent attempts, exclude both first attempt codes and terminal codes
                 excluded_options = None
                 if attempt_num > 0:
                     excluded_options = first_attempt_codes.union(terminal_codes)
 
-                prompt, option_map = create_gpt_prompt(
-                    description,
-                    options,
-                    examples,
-                    history,
-                    excluded_options=excluded_options,
-                    recent_classifications=recent_classifications
-                )
+                # Small subtrees are shown whole so the leaf is chosen in one call
+                if flatten_threshold and current_level < max_depth:
+                    subtree = get_subtree(cursor, parent_code, max_depth, flatten_threshold + 1)
+                    if 0 < len(subtree) <= flatten_threshold:
+                        examples = get_examples_for_level(cursor, max_depth, parent_code, max_examples)
+                        prompt, allowed_codes = create_flattened_prompt(
+                            description,
+                            subtree,
+                            examples,
+                            history,
+                            excluded_options=excluded_options,
+                            recent_classifications=recent_classifications,
+                            answer_mode=answer_mode
+                        )
+
+                        if len(allowed_codes) == 1:
+                            # Only one leaf to choose, so skip the model call
+                            selected_code = next(iter(allowed_codes))
+                        else:
+                            cut_short = stop_reason(budget, expires)
+                            if cut_short:
+                                break
+
+                            parse = parse_code_answer if answer_mode == "json" else clean_code_response
+                            selected_code = ask_model(prompt, lambda content: parse(content, allowed_codes),
+                                                      list(allowed_codes), budget, max_reasks, answer_mode,
+                                                      expires=expires)
+                            if selected_code is None:
+                                cut_short = stop_reason(budget, expires)
+                                break
+                            if not selected_code:
+                                break
+
+                        # Fill in the intermediate levels between the current node and the leaf
+                        subtree_descriptions = {code: desc for code, desc, _ in subtree}
+                        for level in range(current_level, determine_sitc_level(selected_code) + 1):
+                            path_code = code_at_level(selected_code, level)
+                            if attempt_num == 0:
+                                first_attempt_codes.add(path_code)
+                            history.append((path_code, subtree_descriptions[path_code]))
+                            attempt_path.append((path_code, subtree_descriptions[path_code]))
+
+                        if determine_sitc_level(selected_code) < max_depth:
+                            terminal_codes.add(selected_code)
+                            print(f"Found terminal code below max depth: {selected_code}")
+                        break
 
-                response = llm.invoke(prompt)
-                choice = clean_gpt_response(response.content)
+                options = get_options_for_level(cursor, current_level, parent_code)
 
-                if choice and choice in option_map:
-                    choice_idx = option_map[choice]
-                    selected_code = options[choice_idx][0]
-                    selected_description = options[choice_idx][1]
+                if not options:
+                    break
 
-                    # Store codes from first attempt's path
-                    if attempt_num == 0:
-                        first_attempt_codes.add(selected_code)
+                available_options = filter_excluded_options(options, excluded_options)
+                if len(available_options) == 1:
+                    # Only one option at this node, so descend without asking the model
+                    selected_code, selected_description = available_options[0]
+                    print(f"Single option at level {current_level}: {selected_code}")
+                else:
+                    examples = get_examples_for_level(cursor, current_level, parent_code, max_examples)
+
+                    prompt, option_map = create_gpt_prompt(
+                        description,
+                        options,
+                        examples,
+                        history,
+                        excluded_options=excluded_options,
+                        recent_classifications=recent_classifications,
+                        answer_mode=answer_mode
+                    )
+
+                    cut_short = stop_reason(budget, expires)
+                    if cut_short:
+                        break
 
-                    history.append((selected_code, selected_description))
-                    attempt_path.append((selected_code, selected_description))
+                    parse = parse_code_answer if answer_mode == "json" else parse_letter_answer
+                    choice = ask_model(prompt, lambda content: parse(content, option_map),
+                                       list(option_map), budget, max_reasks, answer_mode, expires=expires)
 
-                    clean_code = clean_code_for_level(selected_code)
+                    if choice is None:
+                        cut_short = stop_reason(budget, expires)
+                        break
+                    if not choice:
+                        break
 
-                    # Check if this is a terminal code and hasn't reached max depth
-                    if is_terminal_code(cursor, selected_code) and len(clean_code) < max_depth:
-                        terminal_codes.add(selected_code)
-                        print(f"Found terminal code below max depth: {selected_code}")
+                    # option_map indexes the options left after exclusions
+                    selected_code, selected_description = available_options[option_map[choice]]
 
-                    # Stop if we've reached the max depth
-                    if current_level >= max_depth:
-                        break
+                # Store codes from first attempt's path
+                if attempt_num == 0:
+                    first_attempt_codes.add(selected_code)
 
-                    current_level += 1
-                else:
+                history.append((selected_code, selected_description))
+                attempt_path.append((selected_code, selected_description))
+
+                clean_code = clean_code_for_level(selected_code)
+
+                # Check if this is a terminal code and hasn't reached max depth
+                if is_terminal_code(cursor, selected_code) and len(clean_code) < max_depth:
+                    terminal_codes.add(selected_code)
+                    print(f"Found terminal code below max depth: {selected_code}")
+
+                # Stop if we've reached the max depth
+                if current_level >= max_depth:
                     break
 
+                current_level += 1
+
             if attempt_path:
                 deepest = max(attempt_path, key=lambda x: len(x[0]))
                 full_attempts.append(deepest)
                 print(f"Attempt {attempt_num + 1}: {deepest[0]} - {deepest[1]}")
+                if cascade is not None and attempt_num == 0 and cascade.agrees(lexical_guess, deepest[0]):
+                    # Model and scorer agree, so the item is easy and needs no more attempts
+                    print("First attempt agrees with the lexical scorer")
+                    break
             else:
                 print(f"Attempt {attempt_num + 1}: Failed")
 
@@ -248,12 +665,33 @@ def classify_description(description, conn, num_attempts=3, max_depth=4, recent_
             continue
 
     # Replace the consistency check with a final GPT decision
+    if cut_short:
+        return deepest_partial_result(full_attempts, cut_short)
+
     if not full_attempts:
         return "IDK", "Unable to classify"
 
     if len(full_attempts) == 1:
+        if cascade is not None:
+            cascade.record("small")
         return full_attempts[0]
 
+    if not arbitrate or (budget is not None and budget.exhausted()):
+        # Cheap strategy: majority vote, ties going to the earliest attempt
+        if cascade is not None:
+            cascade.record("small")
+        return Counter(full_attempts).most_common(1)[0][0]
+
+    if expires is not None and time.monotonic() >= expires:
+        # No time left for the final decision
+        return deepest_partial_result(full_attempts)
+
+    # With a cascade, the final decision between disagreeing attempts goes to the strong model
+    arbiter = None
+    if cascade is not None:
+        arbiter = cascade.strong_llm
+        cascade.record("strong" if arbiter is not None else "small")
+
     # Create a prompt for the final decision
     template = """You are a trade classification expert. Given multiple classification attempts for the same description, choose the most appropriate one:
 
@@ -262,29 +700,43 @@ Description to classify: {description}
 Available classifications:
 {formatted_options}
 
-Choose the most appropriate classification. IMPORTANT: Respond with ONLY a single letter from A-{last_letter}.
-Do not include any explanations, colons, periods, or the category description."""
+Choose the most appropriate classification. IMPORTANT: {answer_rule}"""
 
     letters = list(string.ascii_uppercase)
     formatted_options = ""
     option_map = {}
 
     for i, (code, desc) in enumerate(full_attempts):
-        letter = letters[i]
-        formatted_options += f"{letter}. {code}: {desc}\n"
-        option_map[letter] = i
+        if answer_mode == "json":
+            if code not in option_map:
+                formatted_options += f"- {code}: {desc}\n"
+                option_map[code] = i
+        else:
+            letter = letters[i]
+            formatted_options += f"{letter}. {code}: {desc}\n"
+            option_map[letter] = i
+
+    if answer_mode == "json":
+        answer_rule = JSON_ANSWER_REMINDER
+        parse = parse_code_answer
+    else:
+        answer_rule = (f"Respond with ONLY a single letter from A-{letters[len(full_attempts)-1]}.\n"
+                       "Do not include any explanations, colons, periods, or the category description.")
+        parse = parse_letter_answer
 
     prompt = ChatPromptTemplate.from_template(template)
     formatted_prompt = prompt.format(
         description=description,
         formatted_options=formatted_options,
-        last_letter=letters[len(full_attempts)-1]
+        answer_rule=answer_rule
     )
 
-    response = llm.invoke(formatted_prompt)
-    choice = clean_gpt_response(response.content)
+    choice = ask_model(formatted_prompt, lambda content: parse(content, option_map),
+                       list(option_map), budget, max_reasks, answer_mode, arbiter, expires)
 
-    if choice and choice in option_map:
+    if choice is None and stop_reason(None, expires):
+        return deepest_partial_result(full_attempts)
+    if choice:
         choice_idx = option_map[choice]
         return full_attempts[choice_idx]
 
@@ -292,23 +744,48 @@ Do not include any explanations, colons, periods, or the category description.""
     return full_attempts[0]
 
 
-def process_batch(descriptions, conn, num_attempts=3, max_depth=4):
-    """Process a batch of descriptions and return results"""
+def process_batch(descriptions, conn, num_attempts=3, max_depth=4, warmup=None, context_window=3, known=None,
+                  **classify_options):
+    """Process a batch of descriptions and return results
+
+    Descriptions in `warmup` are classified first only to fill the context
+    window; their results are not returned. `known` is aligned with warmup +
+    descriptions and holds a result dict (code, sitc_description) for rows
+    already classified, e.g. reused or resolved by concordance. Those rows are
+    not sent to the model but still count as recent context, and their result
+    is returned as given. Extra keyword arguments (budget, flatten_threshold,
+    rules, ...) are passed on to classify_description.
+    """
     results = []
     recent_classifications = []  # Store recent classifications for context
-    context_window = 3  # Number of previous classifications to consider
 
-    for idx, description in enumerate(descriptions, 1):
-        print(f"\n\n==== Processing item {idx}/{len(descriptions)} ====")
-        print(f"Description: {description}")
+    items = [(description, True) for description in (warmup or [])]
+    items += [(description, False) for description in descriptions]
+    known = known or [None] * len(items)
 
-        code, desc = classify_description(
-            description,
-            conn,
-            num_attempts,
-            max_depth,
-            recent_classifications
-        )
+    for idx, ((description, is_warmup), known_result) in enumerate(zip(items, known), 1):
+        if known_result is not None:
+            code, desc = known_result['code'], known_result['sitc_description']
+        else:
+            if is_warmup:
+                print(f"\n\n==== Warm-up item {idx}/{len(warmup)} ====")
+            else:
+                print(f"\n\n==== Processing item {idx - len(warmup or [])}/{len(descriptions)} ====")
+            print(f"Description: {description}")
+
+            _warmup.active = is_warmup
+            try:
+                result = classify_description(
+                    description,
+                    conn,
+                    num_attempts,
+                    max_depth,
+                    recent_classifications,
+                    **classify_options
+                )
+            finally:
+                _warmup.active = False
+            code, desc = result
 
         # Update recent classifications
         recent_classifications.append({
@@ -320,12 +797,59 @@ def process_batch(descriptions, conn, num_attempts=3, max_depth=4):
         if len(recent_classifications) > context_window:
             recent_classifications.pop(0)
 
-        results.append({
-            "description": description,
-            "code": code,
-            "sitc_description": desc
-        })
+        if is_warmup:
+            continue
+        if known_result is not None:
+            results.append(known_result)
+        else:
+            results.append({
+                "description": description,
+                "code": code,
+                "sitc_description": desc,
+                "partial": getattr(result, "partial", False)
+            })
+
+    return results
+
+
+def process_batch_parallel(descriptions, db_path="sitc.db", num_attempts=3, max_depth=4,
+                           num_shards=4, overlap=3, context_window=3, known=None, **classify_options):
+    """Process descriptions as contiguous shards in parallel, keeping neighbour context
 
+    Each shard after the first re-classifies the `overlap` descriptions just
+    before it as a warm-up, so its first items see the same kind of recent
+    context a serial run would give them. `known` is aligned with
+    descriptions (see process_batch). Results come back in input order.
+    """
+    if num_shards <= 1 or len(descriptions) <= overlap + 1:
+        conn = sqlite3.connect(db_path)
+        try:
+            return process_batch(descriptions, conn, num_attempts, max_depth, context_window=context_window,
+                                 known=known, **classify_options)
+        finally:
+            conn.close()
+
+    shard_size = -(-len(descriptions) // num_shards)
+    bounds = [(start, min(start + shard_size, len(descriptions)))
+              for start in range(0, len(descriptions), shard_size)]
+
+    def run_shard(start, end):
+        # sqlite3 connections cannot be shared between threads
+        conn = sqlite3.connect(db_path)
+        try:
+            warmup_start = max(0, start - overlap)
+            return process_batch(descriptions[start:end], conn, num_attempts, max_depth,
+                                 warmup=descriptions[warmup_start:start], context_window=context_window,
+                                 known=known[warmup_start:end] if known is not None else None,
+                                 **classify_options)
+        finally:
+            conn.close()
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        futures = [executor.submit(run_shard, start, end) for start, end in bounds]
+        for future in futures:
+            results.extend(future.result())
     return results
 
 
@@ -0,0 +1,156 @@
+import re
+import sqlite3
+import argparse
+from pathlib import Path
+import pandas as pd
+from training_store import determine_sitc_level, code_at_level
+
+
+def ensure_concordance_schema(conn):
+    """Make sure the concordance table and its lookup index exist"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS concordance (
+            system TEXT NOT NULL,
+            source_code TEXT NOT NULL,
+            sitc_code TEXT NOT NULL,
+            FOREIGN KEY (sitc_code) REFERENCES sitc_codes (code)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_concordance_source ON concordance (system, source_code)")
+    conn.commit()
+
+
+def normalize_source_codes(codes):
+    """Vectorized key for source codes: upper case with spaces, dots and dashes removed"""
+    if pd.api.types.is_float_dtype(codes):
+        # Whole-number codes are read as floats when the column has blanks
+        try:
+            codes = codes.astype('Int64')
+        except (TypeError, ValueError):
+            pass
+    codes = codes.astype('string').fillna('').astype(str)
+    return codes.str.upper().str.replace(r'[^0-9A-Z]', '', regex=True)
+
+
+def normalize_sitc_code(code):
+    """Write a target code the way sitc_codes does (e.g. 00111 -> 001.11)"""
+    code = str(code).strip()
+    digits = re.sub(r'\D', '', code)
+    if '.' not in code and len(digits) > 3:
+        return f"{digits[:3]}.{digits[3:]}"
+    return code
+
+
+def load_concordance(conn, path, system, source_col='source_code', target_col='sitc_code', replace=False):
+    """Load a source -> SITC mapping table (.csv or .xlsx) under the given system name
+
+    A source code may map to several SITC codes; such codes are treated as
+    ambiguous at lookup time unless all targets share the same ancestor at the
+    requested depth. Rows whose target is not in sitc_codes are skipped.
+    Returns (loaded, skipped).
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    else:
+        df = pd.read_excel(path, dtype=str).fillna('')
+
+    ensure_concordance_schema(conn)
+    known = {row[0] for row in conn.execute("SELECT code FROM sitc_codes")}
+    keys = normalize_source_codes(df[source_col])
+    targets = df[target_col].map(normalize_sitc_code)
+    valid = (keys != '') & targets.isin(known)
+    rows = pd.DataFrame({'system': system, 'source_code': keys[valid], 'sitc_code': targets[valid]}).drop_duplicates()
+
+    if replace:
+        conn.execute("DELETE FROM concordance WHERE system = ?", (system,))
+    conn.executemany("INSERT INTO concordance (system, source_code, sitc_code) VALUES (?, ?, ?)",
+                     rows.itertuples(index=False, name=None))
+    conn.commit()
+    return len(rows), int((~valid).sum())
+
+
+class Concordance:
+    """Resolve source codes of one system to SITC codes by table lookup
+
+    Targets are truncated to `max_depth`. Source codes mapping to more than
+    one code at that depth are ambiguous and left unresolved. Codes not in
+    the table are retried with their last characters dropped, down to
+    `min_prefix` characters, so national 8- or 10-digit HS codes fall back to
+    their 6-digit subheading. Odd-length numeric codes also get back the
+    leading zero lost when Excel stored them as numbers. Both apply only to
+    systems named HS*; other codes must match the table exactly.
+    """
+
+    def __init__(self, conn, system, max_depth=4, min_prefix=4):
+        self.system = system
+        self.min_prefix = min_prefix
+        ensure_concordance_schema(conn)
+        mapping = pd.read_sql_query("SELECT source_code, sitc_code FROM concordance WHERE system = ?",
+                                    conn, params=(system,))
+        if mapping.empty:
+            print(f"No concordance loaded for {system}")
+        mapping['sitc_code'] = [code_at_level(code, max_depth) if determine_sitc_level(code) > max_depth else code
+                                for code in mapping['sitc_code']]
+        targets = mapping.drop_duplicates().groupby('source_code')['sitc_code']
+        unique = targets.nunique() == 1
+        self.ambiguous = set(unique.index[~unique])
+        self.codes = targets.first()[unique]
+        self.descriptions = pd.read_sql_query("SELECT code, description FROM sitc_codes", conn).set_index('code')['description']
+        self.max_key = int(self.codes.index.str.len().max()) if len(self.codes) else 0
+
+    def lookup(self, source_codes):
+        """Return code, sitc_description (NaN where unresolved) and ambiguous columns per input row"""
+        keys = normalize_source_codes(pd.Series(source_codes))
+        hs = self.system.upper().startswith('HS')
+        if hs:
+            # HS codes have an even number of digits, and lose their leading zero
+            # when stored as numbers in Excel (010121 -> 10121)
+            unpadded = (keys.str.isdigit() & (keys.str.len() % 2 == 1)
+                        & ~keys.isin(self.codes.index) & ~keys.isin(self.ambiguous))
+            keys = keys.where(~unpadded, '0' + keys)
+        codes = keys.map(self.codes)
+        ambiguous = keys.isin(self.ambiguous)
+        # Only HS has national extensions below the table's codes
+        for length in range(self.max_key if hs else 0, self.min_prefix - 1, -1):
+            missing = codes.isna() & ~ambiguous & (keys.str.len() > length)
+            if not missing.any():
+                continue
+            prefixes = keys[missing].str[:length]
+            codes.loc[missing] = prefixes.map(self.codes)
+            ambiguous.loc[missing] = prefixes.isin(self.ambiguous)
+        codes.loc[keys == ''] = None
+        return pd.DataFrame({'code': codes, 'sitc_description': codes.map(self.descriptions),
+                             'ambiguous': ambiguous})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load concordance tables (HS -> SITC, SITC revisions) into the database')
+    parser.add_argument('--db', default='sitc.db', help='Path to the SITC database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    load_parser = subparsers.add_parser('load', help='Load a mapping table from .csv or .xlsx')
+    load_parser.add_argument('path')
+    load_parser.add_argument('--system', required=True, help='Name of the source code system, e.g. HS2017 or SITC3')
+    load_parser.add_argument('--source-col', default='source_code', help='Column holding the source codes')
+    load_parser.add_argument('--target-col', default='sitc_code', help='Column holding the SITC codes')
+    load_parser.add_argument('--replace', action='store_true', help='Drop earlier rows for this system first')
+
+    subparsers.add_parser('list', help='Show the loaded systems')
+
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    ensure_concordance_schema(conn)
+
+    if args.command == 'load':
+        loaded, skipped = load_concordance(conn, args.path, args.system, args.source_col, args.target_col, args.replace)
+        print(f"Loaded {loaded} mappings for {args.system}, skipped {skipped} rows with an empty or unknown code")
+    else:
+        for system, rows, sources in conn.execute("""
+            SELECT system, COUNT(*), COUNT(DISTINCT source_code)
+            FROM concordance
+            GROUP BY system
+        """):
+            print(f"{system}: {rows} mappings for {sources} source codes")
+
+    conn.close()
@@ -0,0 +1,193 @@
+import os
+import csv
+import random
+import sqlite3
+import tempfile
+import time
+import argparse
+import itertools
+from contextlib import redirect_stdout
+from classifier import process_batch_parallel, usage_stats, warmup_usage_stats, get_llm, set_llm
+from training_store import determine_sitc_level, code_at_level
+from llm_backends import SimulatedLLM, RecordingLLM, ReplayLLM
+from cascade import Cascade, chat_model
+
+
+def load_holdout(conn, fraction=0.2, limit=None, seed=0):
+    """Pick held-out training examples, returned in their original list order"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT rowid, description, sitc_code FROM training_examples ORDER BY rowid")
+    rows = cursor.fetchall()
+    count = limit if limit is not None else int(len(rows) * fraction)
+    holdout = random.Random(seed).sample(rows, min(count, len(rows)))
+    return sorted(holdout)
+
+
+def create_eval_database(db_path, holdout, target_path):
+    """Copy the database without the held-out examples
+
+    Every example sharing a description with a held-out item is removed too,
+    so neither the prompt examples nor the known-match index can leak answers.
+    """
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(target_path)
+    source.backup(target)
+    source.close()
+    target.executemany("DELETE FROM training_examples WHERE description = ?",
+                       [(description,) for _, description, _ in holdout])
+    target.commit()
+    target.close()
+
+
+def score_predictions(truths, predictions, max_depth):
+    """Accuracy at each level, counting only items whose true code reaches that level"""
+    accuracy = {}
+    for level in range(1, max_depth + 1):
+        pairs = [(truth, prediction) for truth, prediction in zip(truths, predictions)
+                 if determine_sitc_level(truth) >= level]
+        if not pairs:
+            continue
+        correct = sum(1 for truth, prediction in pairs
+                      if prediction != 'IDK' and determine_sitc_level(prediction) >= level
+                      and code_at_level(prediction, level) == code_at_level(truth, level))
+        accuracy[level] = correct / len(pairs)
+    return accuracy
+
+
+def evaluate_config(eval_db, holdout, num_attempts, max_depth, max_examples, context_window, workers=4,
+                    verbose=False, **classify_options):
+    """Classify the held-out items under one configuration and return its metrics"""
+    descriptions = [description for _, description, _ in holdout]
+    truths = [code for _, _, code in holdout]
+
+    cascade = classify_options.get('cascade')
+    if cascade is not None:
+        cascade.tiers.clear()
+    usage_stats.reset()
+    warmup_usage_stats.reset()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(None if verbose else devnull):
+        results = process_batch_parallel(descriptions, eval_db, num_attempts, max_depth,
+                                         num_shards=workers, overlap=context_window,
+                                         context_window=context_window, max_examples=max_examples,
+                                         **classify_options)
+    wall = time.perf_counter() - start
+
+    predictions = [result['code'] for result in results]
+    # Shard warm-ups are an artefact of running in parallel, not a cost per held-out item
+    warmup = warmup_usage_stats.snapshot()
+    usage = {field: count - warmup[field] for field, count in usage_stats.snapshot().items()}
+    items = len(descriptions)
+    metrics = {
+        'num_attempts': num_attempts,
+        'max_depth': max_depth,
+        'max_examples': max_examples,
+        'context_window': context_window,
+        'items': items,
+        'calls_per_item': round(usage['calls'] / items, 2),
+        'tokens_per_item': round((usage['prompt_tokens'] + usage['completion_tokens']) / items, 1),
+        'cached_share': round(usage['cached_tokens'] / usage['prompt_tokens'], 3) if usage['prompt_tokens'] else 0,
+        'seconds_per_item': round(wall / items, 3),
+        'idk_rate': round(predictions.count('IDK') / items, 3),
+    }
+    if cascade is not None:
+        # Shares of the items routed by the cascade, which include shard warm-ups
+        routed = sum(cascade.tiers.values()) or 1
+        metrics['lexical_share'] = round(cascade.tiers['lexical'] / routed, 3)
+        metrics['escalated_share'] = round(cascade.tiers['strong'] / routed, 3)
+    for level, value in score_predictions(truths, predictions, max_depth).items():
+        metrics[f'accuracy_l{level}'] = round(value, 3)
+    return metrics
+
+
+def run_grid(db_path, attempts, depths, examples, contexts, fraction=0.2, limit=None, seed=0, workers=4,
+             verbose=False, **classify_options):
+    """Evaluate every combination of the given settings on one held-out set"""
+    conn = sqlite3.connect(db_path)
+    holdout = load_holdout(conn, fraction, limit, seed)
+    conn.close()
+    print(f"Held out {len(holdout)} training examples")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        eval_db = os.path.join(tmp, 'eval.db')
+        create_eval_database(db_path, holdout, eval_db)
+        for num_attempts, max_depth, max_examples, context_window in itertools.product(attempts, depths, examples, contexts):
+            print(f"Evaluating attempts={num_attempts} depth={max_depth} examples={max_examples} context={context_window}")
+            metrics = evaluate_config(eval_db, holdout, num_attempts, max_depth, max_examples, context_window,
+                                      workers, verbose, **classify_options)
+            print("  " + ", ".join(f"{key}={value}" for key, value in metrics.items()
+                                   if key.startswith(('accuracy', 'calls', 'tokens', 'seconds'))))
+            rows.append(metrics)
+    return rows
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure accuracy against cost on held-out training examples')
+    parser.add_argument('--db', default='sitc.db', help='Path to the SITC database')
+    parser.add_argument('--fraction', type=float, default=0.2, help='Share of training examples to hold out')
+    parser.add_argument('--limit', type=int, help='Hold out exactly this many examples instead')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the hold-out split')
+    parser.add_argument('--attempts', type=_int_list, default=[3], help='Comma-separated num_attempts values')
+    parser.add_argument('--depths', type=_int_list, default=[4], help='Comma-separated max_depth values')
+    parser.add_argument('--examples', type=_int_list, default=[5], help='Comma-separated example counts')
+    parser.add_argument('--contexts', type=_int_list, default=[3], help='Comma-separated context window sizes')
+    parser.add_argument('--workers', type=int, default=4, help='Parallel shards per configuration')
+    parser.add_argument('--answer-mode', choices=['letter', 'json'], default='letter',
+                        help='Ask for a lettered option, or for the code as schema-constrained JSON')
+    parser.add_argument('--cascade', action='store_true', help='Evaluate with the tiered model cascade')
+    parser.add_argument('--strong-model', default='gpt-4o', help='Strong model for escalated items ("none" to disable)')
+    parser.add_argument('--lexical-confidence', type=float, default=0.6,
+                        help='Scorer confidence at which the cascade skips the model entirely')
+    parser.add_argument('--backend', choices=['openai', 'simulated'], default='openai')
+    parser.add_argument('--record', metavar='PATH', help='Record model calls to a transcript')
+    parser.add_argument('--replay', metavar='PATH', help='Answer model calls from a recorded transcript')
+    parser.add_argument('--output', help='Write the results table to this CSV file')
+    parser.add_argument('--verbose', action='store_true', help='Show per-item classifier output')
+    args = parser.parse_args()
+
+    backend = None
+    if args.replay:
+        backend = ReplayLLM(args.replay, fallback=SimulatedLLM() if args.backend == 'simulated' else None)
+        set_llm(backend)
+    else:
+        if args.backend == 'simulated':
+            set_llm(SimulatedLLM())
+        if args.record:
+            backend = RecordingLLM(get_llm(), args.record)
+            set_llm(backend)
+
+    cascade = None
+    if args.cascade:
+        strong_llm = None
+        if args.strong_model != 'none':
+            if args.replay:
+                strong_llm = ReplayLLM(fallback=backend.fallback, shared_with=backend, model_name=args.strong_model)
+            elif args.backend == 'simulated':
+                strong_llm = SimulatedLLM()
+            else:
+                strong_llm = chat_model(args.strong_model)
+            if args.record and not args.replay:
+                strong_llm = RecordingLLM(strong_llm, shared_with=backend)
+        cascade = Cascade(strong_llm, args.lexical_confidence)
+
+    rows = run_grid(args.db, args.attempts, args.depths, args.examples, args.contexts,
+                    args.fraction, args.limit, args.seed, args.workers, args.verbose,
+                    answer_mode=args.answer_mode, cascade=cascade)
+
+    if args.output:
+        fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Results saved to: {args.output}")
+
+    if backend is not None:
+        print(backend.report())
+        if isinstance(backend, RecordingLLM):
+            backend.close()
@@ -0,0 +1,363 @@
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from usage import extract_token_usage
+
+
+class LLMResponse:
+    """Minimal stand-in for a LangChain AIMessage"""
+
+    def __init__(self, content, response_metadata=None, usage_metadata=None):
+        self.content = content
+        self.response_metadata = response_metadata or {}
+        self.usage_metadata = usage_metadata
+
+
+def _words(text):
+    return set(re.findall(r'\w{3,}', text.lower()))
+
+
+class SimulatedLLM:
+    """Local stand-in for the chat model, for tests and offline runs
+
+    Picks the listed option whose description shares the most words with the
+    description being classified. Answers are deterministic and cost nothing,
+    so runs against it only exercise the tree walk, SQLite and I/O paths.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def invoke(self, prompt, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+        text = str(prompt)
+        match = re.search(r'Description to classify: (.*)', text)
+        description_words = _words(match.group(1)) if match else set()
+
+        # Lettered options ("A. 001: ...") are answered with the letter,
+        # flattened subtrees ("  * 001.1: ...") and code lists ("- 001: ...")
+        # with the code itself
+        options = re.findall(r'^([A-Z])\. \S+: (.*)$', text, re.MULTILINE)
+        if not options:
+            options = re.findall(r'^\s*[*-] (\d[\d.]*): (.*)$', text, re.MULTILINE)
+
+        best_answer, best_score = "", -1
+        for answer, option_desc in options:
+            score = len(description_words & _words(option_desc))
+            if score > best_score:
+                best_answer, best_score = answer, score
+
+        if kwargs.get('response_format'):
+            # Structured-output calls get the JSON object the schema asks for
+            best_answer = json.dumps({'code': best_answer})
+
+        prompt_tokens = len(text.split())
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': 1, 'total_tokens': prompt_tokens + 1}
+        return LLMResponse(best_answer, response_metadata={'token_usage': usage})
+
+
+def prompt_key(prompt, **kwargs):
+    """Stable hash identifying a prompt (and any extra call options) in a transcript"""
+    text = str(prompt)
+    if kwargs:
+        text += json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+def _open_transcript(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class RecordingLLM:
+    """Wrap a chat model and append every prompt/response pair to a transcript
+
+    Each line is a JSON object with the prompt hash, the response text, the
+    call latency and the reported token usage. Prompt text is only stored with
+    store_prompts=True. Paths ending in .gz are gzip-compressed. A second
+    model can be recorded into the same transcript with `shared_with`.
+    """
+
+    def __init__(self, inner, path=None, store_prompts=False, shared_with=None):
+        self.inner = inner
+        self.store_prompts = store_prompts
+        if shared_with is not None:
+            self.path = shared_with.path
+            self.lock = shared_with.lock
+            self.file = shared_with.file
+        else:
+            self.path = path
+            self.lock = threading.Lock()
+            self.file = _open_transcript(path, 'a')
+        self.recorded = 0
+
+    @property
+    def model_name(self):
+        return getattr(self.inner, 'model_name', None)
+
+    def invoke(self, prompt, **kwargs):
+        start = time.perf_counter()
+        response = self.inner.invoke(prompt, **kwargs)
+        latency = time.perf_counter() - start
+
+        entry = {
+            'key': prompt_key(prompt, **kwargs),
+            'response': response.content,
+            'latency': round(latency, 4),
+            'usage': list(extract_token_usage(response)),
+        }
+        if self.store_prompts:
+            entry['prompt'] = str(prompt)
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.recorded += 1
+        return response
+
+    def report(self):
+        return f"Recorded {self.recorded} calls to {self.path}"
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayLLM:
+    """Serve responses from a transcript written by RecordingLLM
+
+    `latency` is a fixed simulated delay in seconds, or "recorded" to sleep for
+    each call's original latency. Prompts missing from the transcript are
+    counted and reported; they are answered by `fallback` if given, otherwise
+    with an empty response (which the classifier treats as an invalid answer).
+    A second model recorded into the same transcript is replayed with
+    `shared_with`, under its own `model_name` so budgets price it correctly.
+    """
+
+    def __init__(self, path=None, latency=0.0, fallback=None, shared_with=None, model_name=None):
+        self.latency = latency
+        self.fallback = fallback
+        self.model_name = model_name
+        if shared_with is not None:
+            self.path = shared_with.path
+            self.lock = shared_with.lock
+            self.responses = shared_with.responses
+            self.cursors = shared_with.cursors
+            self.counts = shared_with.counts
+            self.misses = shared_with.misses
+            return
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.responses = defaultdict(list)
+        self.cursors = Counter()
+        self.counts = Counter()
+        self.misses = Counter()
+
+        with _open_transcript(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses[entry['key']].append(entry)
+
+    def invoke(self, prompt, **kwargs):
+        key = prompt_key(prompt, **kwargs)
+        with self.lock:
+            entries = self.responses.get(key)
+            if entries:
+                # Repeated prompts get their recorded responses in order
+                entry = entries[self.cursors[key] % len(entries)]
+                self.cursors[key] += 1
+                self.counts['served'] += 1
+            else:
+                entry = None
+                self.misses[key] += 1
+
+        if entry is None:
+            print(f"Replay miss: prompt {key} is not in {self.path}")
+            if self.fallback is not None:
+                return self.fallback.invoke(prompt, **kwargs)
+            return LLMResponse("")
+
+        delay = entry.get('latency', 0) if self.latency == 'recorded' else self.latency
+        if delay:
+            time.sleep(delay)
+
+        prompt_tokens, cached_tokens, completion_tokens = entry.get('usage') or (0, 0, 0)
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        }
+        return LLMResponse(entry['response'], response_metadata={'token_usage': usage})
+
+    def report(self):
+        unseen = sum(self.misses.values())
+        return (f"Replay: {self.counts['served']} responses served, {unseen} calls with unseen prompts "
+                f"({len(self.misses)} distinct)")
+
+
+def with_request_timeout(backend, timeout):
+    """Rebuild an OpenAI chat model with a request timeout and no retries; other backends are returned as is"""
+    if timeout is None:
+        return backend
+    try:
+        from langchain_openai import ChatOpenAI
+    except ImportError:
+        return backend
+    if not isinstance(backend, ChatOpenAI):
+        return backend
+    from cascade import chat_model
+    return chat_model(backend.model_name, timeout)
+
+
+class HedgedLLM:
+    """Wrap a chat model with a per-call timeout and optional hedged requests
+
+    Every call runs on a worker thread and raises TimeoutError once it has
+    run for `timeout` seconds (None for no limit); time spent waiting for a
+    free worker does not count. An OpenAI chat model is rebuilt with the same
+    request timeout and no client retries, so an abandoned request is aborted
+    and frees its worker. With hedge=True, a call still running after the observed
+    `percentile` latency (once `min_samples` calls have finished) gets a
+    duplicate request; the first answer wins and the other is cancelled or,
+    if already in flight, discarded when it returns. Hedges are capped at
+    `max_hedge_ratio` of all calls. Tokens used by discarded responses are
+    counted in the report, since they are not charged anywhere else.
+    """
+
+    def __init__(self, inner, timeout=60.0, hedge=False, max_hedge_ratio=0.1, percentile=0.95,
+                 min_samples=20, window=500, max_workers=32):
+        self.inner = with_request_timeout(inner, timeout)
+        self.timeout = timeout
+        self.hedge = hedge
+        self.max_hedge_ratio = max_hedge_ratio
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-call")
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.counts = Counter()
+        self.discarded_tokens = 0
+
+    @property
+    def model_name(self):
+        return getattr(self.inner, 'model_name', None)
+
+    def _call(self, prompt, kwargs, started):
+        start = time.perf_counter()
+        started.append(start)
+        response = self.inner.invoke(prompt, **kwargs)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return response
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging a call, or None if hedging is off or not yet calibrated"""
+        with self.lock:
+            if not self.hedge or len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+
+    def _claim_hedge(self):
+        with self.lock:
+            if self.counts['hedges'] + 1 > self.max_hedge_ratio * self.counts['calls']:
+                return False
+            self.counts['hedges'] += 1
+            return True
+
+    def _discard(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        prompt_tokens, _, completion_tokens = extract_token_usage(future.result())
+        with self.lock:
+            self.discarded_tokens += prompt_tokens + completion_tokens
+
+    def _wait(self, futures, started, limit):
+        """Wait until a future is done or `limit` seconds have passed since the first request started
+
+        While every request is still queued for a worker the clock does not run.
+        """
+        while True:
+            if limit is None:
+                remaining = None
+            elif started:
+                remaining = max(limit - (time.perf_counter() - started[0]), 0)
+            else:
+                remaining = limit
+            was_started = bool(started)
+            done, _ = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            if done or was_started:
+                return done
+
+    def invoke(self, prompt, **kwargs):
+        with self.lock:
+            self.counts['calls'] += 1
+        started = []
+        primary = self.executor.submit(self._call, prompt, kwargs, started)
+        futures = [primary]
+
+        delay = self.hedge_delay()
+        if delay is not None and (self.timeout is None or delay < self.timeout):
+            done = self._wait(futures, started, delay)
+            if not done and self._claim_hedge():
+                futures.append(self.executor.submit(self._call, prompt, kwargs, started))
+
+        winner, error = None, None
+        while futures and winner is None:
+            done = self._wait(futures, started, self.timeout)
+            if not done:
+                break
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None and winner is None:
+                    winner = future
+                elif future.exception() is not None:
+                    error = future.exception()
+
+        for future in futures:
+            if not future.cancel():
+                future.add_done_callback(self._discard)
+
+        if winner is None:
+            if error is not None:
+                raise error
+            with self.lock:
+                self.counts['timeouts'] += 1
+            raise TimeoutError(f"Model call timed out after {self.timeout}s")
+        if winner is not primary:
+            with self.lock:
+                self.counts['hedge_wins'] += 1
+        return winner.result()
+
+    def snapshot(self):
+        with self.lock:
+            ordered = sorted(self.latencies)
+            stats = dict(self.counts)
+            stats['discarded_tokens'] = self.discarded_tokens
+        for name in ('calls', 'hedges', 'hedge_wins', 'timeouts'):
+            stats.setdefault(name, 0)
+        stats['hedge_ratio'] = round(stats['hedges'] / stats['calls'], 4) if stats['calls'] else 0
+        for percentile in (50, 95, 99):
+            key = f'p{percentile}_seconds'
+            stats[key] = round(ordered[min(len(ordered) - 1, len(ordered) * percentile // 100)], 3) if ordered else 0
+        return stats
+
+    def report(self):
+        stats = self.snapshot()
+        limit = f"limit {self.timeout}s" if self.timeout is not None else "no limit"
+        return (f"Model calls: {stats['calls']}, {stats['timeouts']} timed out ({limit}); "
+                f"hedged {stats['hedges']} ({stats['hedge_ratio']:.1%}, cap {self.max_hedge_ratio:.0%}), "
+                f"{stats['hedge_wins']} hedges answered first, {stats['discarded_tokens']} tokens in discarded responses; "
+                f"latency p50 {stats['p50_seconds']}s, p95 {stats['p95_seconds']}s, p99 {stats['p99_seconds']}s")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
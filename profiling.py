@@ -0,0 +1,180 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+# The profiler collecting data for the current run, if any
+_active = None
+_local = threading.local()
+
+
+class Profiler:
+    """Collect cProfile data, per-stage wall-clock times and sampled stacks for one run
+
+    Stage times are recorded by the `stage` context manager and the `timed`
+    decorator, which cost almost nothing while no profiler is active. A
+    background thread samples the stacks of all threads every
+    `sample_interval` seconds for a flamegraph-compatible folded stack file.
+    cProfile itself only sees the thread that started the profiler.
+    """
+
+    def __init__(self, output_prefix='profile', sample_interval=0.005):
+        self.output_prefix = output_prefix
+        self.sample_interval = sample_interval
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.stage_totals = defaultdict(float)
+        self.stage_counts = Counter()
+        self.samples = Counter()
+        self.running = False
+        self.sampler = None
+        self.started = None
+        self.wall = 0.0
+
+    def record(self, path, elapsed):
+        with self.lock:
+            self.stage_totals[path] += elapsed
+            self.stage_counts[path] += 1
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        names = {}
+        while self.running:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread'))
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.running = True
+        self.sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.running = False
+        self.sampler.join()
+        self.wall = time.perf_counter() - self.started
+
+    def stage_report(self):
+        """Stage totals sorted by time, with share of the run's wall-clock time"""
+        lines = [f"{'stage':<60} {'calls':>8} {'total s':>10} {'mean ms':>10} {'% wall':>7}"]
+        for path, total in sorted(self.stage_totals.items(), key=lambda item: -item[1]):
+            count = self.stage_counts[path]
+            share = total / self.wall if self.wall else 0
+            lines.append(f"{path:<60} {count:>8} {total:>10.3f} {1000 * total / count:>10.2f} {share:>7.1%}")
+        return "\n".join(lines)
+
+    def stage_folded(self):
+        """Stage times as folded stacks (microseconds of exclusive time per stage path)"""
+        children = defaultdict(float)
+        for path, total in self.stage_totals.items():
+            if ';' in path:
+                children[path.rsplit(';', 1)[0]] += total
+        lines = []
+        for path, total in sorted(self.stage_totals.items()):
+            exclusive = max(total - children[path], 0)
+            lines.append(f"{path} {int(exclusive * 1_000_000)}")
+        return "\n".join(lines)
+
+    def write_reports(self):
+        """Write the text report, raw cProfile data and folded stack files"""
+        stats_stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stats_stream)
+        stats.sort_stats('cumulative').print_stats(50)
+
+        report_path = f"{self.output_prefix}.txt"
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write(f"Wall-clock time: {self.wall:.3f} s\n\n")
+            f.write("== Stages ==\n")
+            f.write(self.stage_report() + "\n\n")
+            f.write("== cProfile (main thread, by cumulative time) ==\n")
+            f.write(stats_stream.getvalue())
+
+        self.profile.dump_stats(f"{self.output_prefix}.prof")
+
+        with open(f"{self.output_prefix}.folded", 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        with open(f"{self.output_prefix}.stages.folded", 'w', encoding='utf-8') as f:
+            f.write(self.stage_folded() + "\n")
+
+        return report_path
+
+
+@contextmanager
+def profile_run(output_prefix='profile', sample_interval=0.005):
+    """Profile everything inside the block and write reports to <output_prefix>.*"""
+    global _active
+    profiler = Profiler(output_prefix, sample_interval)
+    _active = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = None
+        report_path = profiler.write_reports()
+        print(f"\n{profiler.stage_report()}")
+        print(f"Profile written to {report_path} (.prof, .folded and .stages.folded alongside)")
+
+
+@contextmanager
+def stage(name):
+    """Time a named stage of the run; nested stages are reported as parent;child"""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(';'.join(stack), time.perf_counter() - start)
+        stack.pop()
+
+
+def timed(name):
+    """Decorator that records every call of a function as the given stage"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, name):
+    """Yield from an iterable, recording the time spent producing each item as a stage"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,57 @@
+import re
+import csv
+import json
+from pathlib import Path
+
+
+class Rule:
+    """A user-supplied shortcut: descriptions matching `pattern` go under `code`"""
+
+    def __init__(self, pattern, code, kind='keyword'):
+        self.pattern = pattern
+        self.code = str(code).strip()
+        self.kind = kind
+        if kind == 'regex':
+            self.regex = re.compile(pattern, re.IGNORECASE)
+        elif kind == 'keyword':
+            self.regex = re.compile(r'\b' + re.escape(pattern.strip()) + r'\b', re.IGNORECASE)
+        else:
+            raise ValueError(f"Unknown rule type '{kind}' for pattern: {pattern}")
+
+    def matches(self, description):
+        return self.regex.search(str(description)) is not None
+
+    def __repr__(self):
+        return f"Rule({self.kind}: {self.pattern!r} -> {self.code})"
+
+
+def load_rules(path):
+    """Load a rule table from CSV or JSON
+
+    Each rule has a `pattern`, a `code` (a full code or a prefix such as "05")
+    and an optional `type` of "keyword" (default, whole-word and
+    case-insensitive) or "regex". Rules are tried in file order.
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.json':
+        with open(path, encoding='utf-8') as f:
+            rows = json.load(f)
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+
+    rules = []
+    for row in rows:
+        if not row.get('pattern') or not row.get('code'):
+            continue
+        rules.append(Rule(row['pattern'], row['code'], (row.get('type') or 'keyword').strip().lower()))
+    print(f"Loaded {len(rules)} rules from {path}")
+    return rules
+
+
+def match_rule(description, rules):
+    """Return the first rule matching the description, or None"""
+    for rule in rules or []:
+        if rule.matches(description):
+            return rule
+    return None
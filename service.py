@@ -0,0 +1,288 @@
+import json
+import sqlite3
+import threading
+import time
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from classifier import classify_description, set_llm, get_llm, usage_stats
+
+
+class QueueFull(Exception):
+    """Raised when the service cannot accept more pending descriptions"""
+
+
+class ClassificationQueue:
+    """Queue descriptions from concurrent requests for a pool of classifying workers
+
+    Each description is dispatched as soon as a worker is free. Duplicates,
+    whether already being classified or in the result cache, are classified
+    only once: later requests wait on the in-flight result or get the cached
+    one. At most `max_queue` descriptions may wait; beyond that submit()
+    raises QueueFull. With a per-item `deadline`, partial results are returned
+    but not cached.
+    """
+
+    def __init__(self, db_path="sitc.db", max_queue=256, workers=4, num_attempts=3, max_depth=4,
+                 cache_size=10000, deadline=None):
+        self.db_path = db_path
+        self.max_queue = max_queue
+        self.num_attempts = num_attempts
+        self.max_depth = max_depth
+        self.cache_size = cache_size
+        self.deadline = deadline
+
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.inflight = {}
+        self.slots = threading.BoundedSemaphore(workers)
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="classify")
+        self.stats = {
+            'requests': 0, 'items': 0, 'classified': 0, 'cache_hits': 0, 'inflight_hits': 0,
+            'rejected': 0, 'errors': 0, 'resolved': 0, 'item_seconds': 0.0,
+        }
+        self.stats_lock = threading.Lock()
+        self.started = time.time()
+        self.running = True
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, name="dispatcher", daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, descriptions):
+        """Queue descriptions for classification and return one Future per description"""
+        futures = [Future() for _ in descriptions]
+        with self.condition:
+            if len(self.pending) + len(descriptions) > self.max_queue:
+                self._count('rejected')
+                raise QueueFull(f"{len(self.pending)} descriptions already pending")
+            now = time.monotonic()
+            for description, future in zip(descriptions, futures):
+                self.pending.append((description, future, now))
+            self._count('requests')
+            self._count('items', len(descriptions))
+            self.condition.notify()
+        return futures
+
+    def classify(self, descriptions, timeout=None):
+        """Blocking helper: classify descriptions and return (code, description) pairs"""
+        return [future.result(timeout) for future in self.submit(descriptions)]
+
+    def _next_item(self):
+        with self.condition:
+            while self.running and not self.pending:
+                self.condition.wait()
+            if not self.running:
+                return None
+            return self.pending.popleft()
+
+    def _dispatch_loop(self):
+        while self.running:
+            item = self._next_item()
+            if item is None:
+                continue
+            description, future, queued_at = item
+            entries = [(future, queued_at)]
+
+            cached = self._cache_get(description)
+            if cached is not None:
+                self._count('cache_hits')
+                self._resolve(entries, cached)
+                continue
+            with self.cache_lock:
+                if description in self.inflight:
+                    self.inflight[description].extend(entries)
+                    self._count('inflight_hits')
+                    continue
+                self.inflight[description] = entries
+            # Wait for a free worker so the pending queue, not the executor, absorbs bursts
+            self.slots.acquire()
+            self.executor.submit(self._classify_one, description)
+
+    def _count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so each worker keeps its own
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.db_path)
+        return self.local.conn
+
+    def _classify_one(self, description):
+        try:
+            result = classify_description(description, self._connection(),
+                                          self.num_attempts, self.max_depth, deadline=self.deadline)
+        except Exception as e:
+            self._count('errors')
+            with self.cache_lock:
+                entries = self.inflight.pop(description)
+            for future, _ in entries:
+                future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+        self._count('classified')
+        with self.cache_lock:
+            if not getattr(result, 'partial', False):
+                self.cache[description] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            entries = self.inflight.pop(description)
+        self._resolve(entries, result)
+
+    def _resolve(self, entries, result):
+        now = time.monotonic()
+        for future, queued_at in entries:
+            self._count('item_seconds', now - queued_at)
+            future.set_result(result)
+        self._count('resolved', len(entries))
+
+    def _cache_get(self, description):
+        with self.cache_lock:
+            if description in self.cache:
+                self.cache.move_to_end(description)
+                return self.cache[description]
+        return None
+
+    def metrics(self):
+        with self.condition:
+            queue_depth = len(self.pending)
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = queue_depth
+        stats['cache_size'] = len(self.cache)
+        stats['uptime_seconds'] = round(time.time() - self.started, 1)
+        resolved = stats['resolved']
+        stats['avg_item_seconds'] = round(stats.pop('item_seconds') / resolved, 3) if resolved else 0
+        stats['llm'] = usage_stats.snapshot()
+        if hasattr(get_llm(), 'snapshot'):
+            # Timeouts, hedges and latency percentiles from a HedgedLLM
+            stats['llm_calls'] = get_llm().snapshot()
+        return stats
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """POST /classify, GET /health and GET /metrics"""
+
+    queue = None
+    request_timeout = 300
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            conn = sqlite3.connect(self.queue.db_path)
+            try:
+                codes = conn.execute("SELECT COUNT(*) FROM sitc_codes").fetchone()[0]
+            finally:
+                conn.close()
+            self._send_json(200, {'status': 'ok', 'sitc_codes': codes})
+        elif self.path == '/metrics':
+            self._send_json(200, self.queue.metrics())
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            if 'descriptions' in payload:
+                descriptions = payload['descriptions']
+                if not isinstance(descriptions, list):
+                    raise TypeError('"descriptions" must be a list')
+            else:
+                descriptions = [payload['description']]
+            if any(d is None for d in descriptions):
+                raise ValueError('Descriptions must not be null')
+            descriptions = [str(d) for d in descriptions]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'error': 'Expected JSON with "description" or "descriptions"'})
+            return
+
+        try:
+            futures = self.queue.submit(descriptions)
+        except QueueFull as e:
+            self._send_json(503, {'error': f'Service busy: {e}'}, headers={'Retry-After': '1'})
+            return
+
+        try:
+            results = [future.result(self.request_timeout) for future in futures]
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+
+        self._send_json(200, {'results': [
+            {'description': description, 'code': result[0], 'sitc_description': result[1],
+             'partial': getattr(result, 'partial', False)}
+            for description, result in zip(descriptions, results)
+        ]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(queue, host="127.0.0.1", port=8000):
+    """Build an HTTP server that answers requests through the given ClassificationQueue"""
+    handler = type('Handler', (ClassificationHandler,), {'queue': queue})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve SITC classifications over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default='sitc.db', help='Path to the SITC database')
+    parser.add_argument('--workers', type=int, default=4, help='Descriptions classified concurrently')
+    parser.add_argument('--max-queue', type=int, default=256, help='Pending descriptions before rejecting with 503')
+    parser.add_argument('--num-attempts', type=int, default=3)
+    parser.add_argument('--max-depth', type=int, default=4)
+    parser.add_argument('--llm', choices=['openai', 'simulated'], default='openai',
+                        help='Use "simulated" to run against the local stand-in')
+    parser.add_argument('--deadline', type=float,
+                        help='Seconds per item before the deepest code reached is returned as partial')
+    parser.add_argument('--timeout', type=float, help='Seconds before a model call is abandoned and retried')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a duplicate request when a call runs past the observed p95 latency')
+    parser.add_argument('--hedge-ratio', type=float, default=0.1, help='Largest share of calls that may be hedged')
+    args = parser.parse_args()
+
+    if args.llm == 'simulated':
+        from llm_backends import SimulatedLLM
+        set_llm(SimulatedLLM())
+    if args.timeout is not None or args.hedge:
+        from llm_backends import HedgedLLM
+        set_llm(HedgedLLM(get_llm(), args.timeout, args.hedge, args.hedge_ratio))
+
+    queue = ClassificationQueue(args.db, args.max_queue, args.workers, args.num_attempts, args.max_depth,
+                                deadline=args.deadline)
+    server = create_server(queue, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.close()
@@ -0,0 +1,255 @@
+import sqlite3
+import threading
+import argparse
+from datetime import datetime, timezone
+from pathlib import Path
+import pandas as pd
+
+
+def determine_sitc_level(code):
+    """Determine SITC level from the code format (same rules as old_versions/convert.py)"""
+    code = str(code).strip()
+    if '.' in code:
+        base, decimal = code.split('.')
+        if len(decimal) == 1:
+            return 4
+        return 5
+    return len(code)
+
+
+def code_at_level(code, level):
+    """Truncate a code to its ancestor at the given level (e.g. 057.71 -> 057.7 at level 4)"""
+    code = str(code).strip()
+    if level <= 3:
+        return code[:level]
+    return code[:level + 1]
+
+
+def normalize_description(description):
+    """Normalize a description for exact-match lookups"""
+    return ' '.join(str(description).lower().split())
+
+
+def ensure_training_schema(conn):
+    """Make sure training_examples exists and carries the provenance columns"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS training_examples (
+            description TEXT,
+            sitc_code TEXT,
+            level INTEGER,
+            FOREIGN KEY (sitc_code) REFERENCES sitc_codes (code)
+        )
+    ''')
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(training_examples)")}
+    if 'source' not in columns:
+        conn.execute("ALTER TABLE training_examples ADD COLUMN source TEXT")
+    if 'added_at' not in columns:
+        conn.execute("ALTER TABLE training_examples ADD COLUMN added_at TEXT")
+    # Backs the duplicate check when examples are added
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_training_examples_pair ON training_examples (description, sitc_code)")
+    conn.commit()
+
+
+def _database_key(conn):
+    """Identify the database file behind a connection"""
+    for _, name, filename in conn.execute("PRAGMA database_list"):
+        if name == 'main':
+            return filename or f":memory:{id(conn)}"
+    return f":memory:{id(conn)}"
+
+
+class ExampleIndex:
+    """In-memory index of verified examples, kept in sync as examples are added"""
+
+    def __init__(self):
+        self.matches = {}
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT t.description, t.sitc_code, s.description
+            FROM training_examples t
+            JOIN sitc_codes s ON t.sitc_code = s.code
+            ORDER BY t.rowid
+        """)
+        for description, code, sitc_description in cursor.fetchall():
+            self.add(description, code, sitc_description)
+        return self
+
+    def add(self, description, code, sitc_description):
+        # Later examples win, so a reviewer correction replaces the older answer
+        with self.lock:
+            self.matches[normalize_description(description)] = (code, sitc_description)
+
+    def lookup(self, description):
+        return self.matches.get(normalize_description(description))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_example_index(conn):
+    """Return the example index for this connection's database, loading it on first use"""
+    key = _database_key(conn)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ExampleIndex().load(conn)
+        return _indexes[key]
+
+
+def add_training_example(conn, description, code, source=None, added_at=None):
+    """Append a verified (description, code) pair to training_examples
+
+    The in-memory index and any lexical scorers for this database are updated
+    in place, so later classifications in the same process see the new
+    example immediately.
+    Returns False if the identical pair is already stored.
+    """
+    description = str(description).strip()
+    code = str(code).strip()
+    if not description or description == '.':
+        raise ValueError("Description is empty")
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT description FROM sitc_codes WHERE code = ?", (code,))
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(f"Unknown SITC code: {code}")
+    sitc_description = row[0]
+
+    ensure_training_schema(conn)
+    cursor.execute("""
+        SELECT COUNT(*)
+        FROM training_examples
+        WHERE description = ? AND sitc_code = ?
+    """, (description, code))
+    if cursor.fetchone()[0] > 0:
+        return False
+
+    if added_at is None:
+        added_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    conn.execute('''
+        INSERT INTO training_examples (description, sitc_code, level, source, added_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (description, code, determine_sitc_level(code), source, added_at))
+    conn.commit()
+
+    get_example_index(conn).add(description, code, sitc_description)
+    # Imported here: cascade builds on this module
+    from cascade import add_to_lexical_scorers
+    add_to_lexical_scorers(conn, description, code)
+    return True
+
+
+def add_training_examples(conn, pairs, source=None, added_at=None):
+    """Append many verified (description, code) pairs in a single transaction
+
+    Pairs with an empty description or an unknown code are reported and
+    skipped, as are pairs already stored or repeated in `pairs`. The
+    in-memory index and lexical scorers are updated as in
+    add_training_example. Returns (added, skipped).
+    """
+    ensure_training_schema(conn)
+    sitc_descriptions = dict(conn.execute("SELECT code, description FROM sitc_codes"))
+    if added_at is None:
+        added_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+    added = []
+    skipped = 0
+    with conn:
+        for description, code in pairs:
+            description = str(description).strip()
+            code = str(code).strip()
+            if not description or description == '.':
+                print("Skipping row: Description is empty")
+                skipped += 1
+                continue
+            if code not in sitc_descriptions:
+                print(f"Skipping row: Unknown SITC code: {code}")
+                skipped += 1
+                continue
+            cursor = conn.execute('''
+                INSERT INTO training_examples (description, sitc_code, level, source, added_at)
+                SELECT ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM training_examples WHERE description = ? AND sitc_code = ?)
+            ''', (description, code, determine_sitc_level(code), source, added_at, description, code))
+            if cursor.rowcount:
+                added.append((description, code))
+            else:
+                skipped += 1
+
+    index = get_example_index(conn)
+    from cascade import add_to_lexical_scorers
+    for description, code in added:
+        index.add(description, code, sitc_descriptions[code])
+        add_to_lexical_scorers(conn, description, code)
+    return len(added), skipped
+
+
+def import_reviewed_file(conn, path, source=None, desc_col=None, code_col='SITC_Code'):
+    """Add every reviewed row of a classified .xlsx/.csv file as a training example
+
+    IDK rows and rows flagged in SITC_Partial are skipped.
+    """
+    path = Path(path)
+    if source is None:
+        source = f"review:{path.name}"
+
+    if path.suffix.lower() == '.csv':
+        frames = {path.name: pd.read_csv(path, dtype=str)}
+    else:
+        frames = pd.read_excel(path, sheet_name=None, dtype=str)
+
+    pairs = []
+    skipped = 0
+    for sheet_name, df in frames.items():
+        col = desc_col
+        if col is None:
+            col = next((c for c in ['Description', 'Descriptions'] if c in df.columns), None)
+        if col is None or code_col not in df.columns:
+            print(f"Skipping sheet without description/code columns: {sheet_name}")
+            continue
+
+        # Partial codes were cut short by a deadline or budget, not reviewed to full depth
+        partial = df['SITC_Partial'].astype(str) == 'True' if 'SITC_Partial' in df.columns else [False] * len(df)
+        for description, code, is_partial in zip(df[col], df[code_col], partial):
+            if pd.isna(description) or pd.isna(code) or str(code).strip() in ('', 'IDK') or is_partial:
+                skipped += 1
+                continue
+            pairs.append((description, code))
+
+    added, duplicates = add_training_examples(conn, pairs, source)
+    return added, skipped + duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add verified classifications to the training examples')
+    parser.add_argument('--db', default='sitc.db', help='Path to the SITC database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help='Add a single verified example')
+    add_parser.add_argument('description')
+    add_parser.add_argument('code')
+    add_parser.add_argument('--source', default='manual', help='Who or what verified this example')
+
+    import_parser = subparsers.add_parser('import', help='Import a reviewed _classified file')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--source', help='Provenance label (default: review:<file name>)')
+    import_parser.add_argument('--desc-col', help='Description column (default: Description/Descriptions)')
+    import_parser.add_argument('--code-col', default='SITC_Code', help='Column holding the verified code')
+
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+
+    if args.command == 'add':
+        if add_training_example(conn, args.description, args.code, source=args.source):
+            print(f"Added example: {args.code} - {args.description}")
+        else:
+            print("Example already present")
+    else:
+        added, skipped = import_reviewed_file(conn, args.path, args.source, args.desc_col, args.code_col)
+        print(f"Added {added} examples, skipped {skipped} rows")
+
+    conn.close()
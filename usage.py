@@ -0,0 +1,55 @@
+import threading
+
+
+def extract_token_usage(response):
+    """Return (prompt_tokens, cached_tokens, completion_tokens) reported for a chat response
+
+    Reads LangChain's usage_metadata when present and falls back to the raw
+    OpenAI token_usage block. Cached tokens are the part of the prompt that the
+    provider served from its prefix cache.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        details = usage.get('input_token_details') or {}
+        return (usage.get('input_tokens', 0) or 0,
+                details.get('cache_read', 0) or 0,
+                usage.get('output_tokens', 0) or 0)
+
+    token_usage = (getattr(response, 'response_metadata', None) or {}).get('token_usage') or {}
+    details = token_usage.get('prompt_tokens_details') or {}
+    return (token_usage.get('prompt_tokens', 0) or 0,
+            details.get('cached_tokens', 0) or 0,
+            token_usage.get('completion_tokens', 0) or 0)
+
+
+class UsageStats:
+    """Running totals of LLM calls and tokens, safe to update from several threads"""
+
+    FIELDS = ['calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.totals = {field: 0 for field in self.FIELDS}
+
+    def record(self, response):
+        prompt_tokens, cached_tokens, completion_tokens = extract_token_usage(response)
+        with self.lock:
+            self.totals['calls'] += 1
+            self.totals['prompt_tokens'] += prompt_tokens
+            self.totals['cached_tokens'] += cached_tokens
+            self.totals['completion_tokens'] += completion_tokens
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.totals)
+
+    def summary(self):
+        totals = self.snapshot()
+        cached_share = totals['cached_tokens'] / totals['prompt_tokens'] if totals['prompt_tokens'] else 0
+        return (f"LLM calls: {totals['calls']}, "
+                f"prompt tokens: {totals['prompt_tokens']} ({totals['cached_tokens']} cached, {cached_share:.1%}), "
+                f"completion tokens: {totals['completion_tokens']}")
@@ -1,71 +1,654 @@
 import pandas as pd
 from pathlib import Path
 import sqlite3
+import hashlib
+import json
+import queue
+import threading
 from tqdm import tqdm
-from classifier import process_batch
+from classifier import process_batch, process_batch_parallel, usage_stats, get_llm, set_llm
 import argparse
+from contextlib import nullcontext
+from budget import Budget, print_cost_projection
+from rules import load_rules
+from profiling import profile_run, stage, timed_iter
+from llm_backends import RecordingLLM, ReplayLLM, HedgedLLM
+from cascade import Cascade, chat_model
+from training_store import normalize_description
+from concordance import Concordance
 
-def process_excel_file(input_path, output_path=None, batch_size=10):
-    """Process an Excel file and add SITC classifications"""
+DESCRIPTION_COLUMNS = ['Description', 'Descriptions']
+STREAM_FORMATS = ['.csv', '.parquet']
+DB_PATH = "sitc.db"
+# Sheets or chunks allowed to wait between the read, classify and write stages
+PIPELINE_DEPTH = 2
+# Classification options that change results, and so are part of each row's hash
+RESULT_SETTINGS = ['num_attempts', 'max_depth', 'context_window', 'max_examples', 'flatten_threshold',
+                   'answer_mode', 'use_known_matches']
+
+
+def resolve_input_path(input_path):
+    """Look for the input in the data folder first, then as given"""
+    data_path = Path("data") / input_path
+    if data_path.exists() or not Path(input_path).exists():
+        return data_path
+    return Path(input_path)
+
+
+def find_description_column(columns, desc_col=None):
+    """Return the description column, either the requested one or a default name"""
+    if desc_col:
+        return desc_col if desc_col in columns else None
+    for col in DESCRIPTION_COLUMNS:
+        if col in columns:
+            return col
+    return None
+
+
+def classify_descriptions(descriptions, conn, batch_size=10, label="descriptions", workers=1, known=None,
+                          **classify_options):
+    """Classify a list of descriptions in batches and return one result dict per description
+
+    With more than one worker the list is split into contiguous shards that are
+    classified in parallel (see classifier.process_batch_parallel). Rows with a
+    result in `known` are not classified but give context to the rows below
+    them. Extra keyword arguments (budget, flatten_threshold, rules, ...) are
+    passed on to process_batch.
+    """
+    if workers > 1:
+        print(f"Processing {label} in {workers} parallel shards")
+        return process_batch_parallel(descriptions, DB_PATH, num_shards=workers, known=known, **classify_options)
+
+    results = []
+    for i in tqdm(range(0, len(descriptions), batch_size),
+                 desc=f"Processing {label}",
+                 unit="batch"):
+        batch = descriptions[i:i + batch_size]
+        batch_known = known[i:i + batch_size] if known is not None else None
+        results.extend(process_batch(batch, conn, known=batch_known, **classify_options))
+    return results
+
+
+def settings_fingerprint(classify_options):
+    """Stable text describing the settings that affect classification results"""
+    settings = {name: classify_options.get(name) for name in RESULT_SETTINGS}
+    if classify_options.get('rules'):
+        settings['rules'] = [(rule.kind, rule.pattern, rule.code) for rule in classify_options['rules']]
+    cascade = classify_options.get('cascade')
+    if cascade is not None:
+        settings['cascade'] = (cascade.accept_confidence, cascade.agree_level, cascade.k,
+                               getattr(cascade.strong_llm, 'model_name', None))
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+def row_hash(description, fingerprint):
+    """Hash of a row's description and the run's settings, used to spot unchanged rows"""
+    text = normalize_description(description) + "\x1f" + fingerprint
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:20]
+
+
+def load_previous_results(path, fingerprint, desc_col=None):
+    """Map row hashes to results from an earlier _classified output (.xlsx, .csv or .parquet)
+
+    Outputs written in delta mode carry a SITC_Hash column. For older outputs
+    the hash is computed from their descriptions, assuming they were
+    classified with the current settings. IDK and partial results are left
+    out so those rows are classified again.
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.csv':
+        frames = [pd.read_csv(path, dtype=str, keep_default_na=False)]
+    elif suffix == '.parquet':
+        frames = [pd.read_parquet(path)]
+    else:
+        frames = list(pd.read_excel(path, sheet_name=None, dtype=str).values())
+
+    previous = {}
+    for df in frames:
+        if 'SITC_Code' not in df.columns:
+            continue
+        if 'SITC_Hash' in df.columns:
+            hashes = df['SITC_Hash'].astype(str)
+        else:
+            col = find_description_column(df.columns, desc_col)
+            if not col:
+                continue
+            print(f"{path.name} has no SITC_Hash column; assuming it was classified with the current settings")
+            hashes = df[col].astype(str).map(lambda description: row_hash(description, fingerprint))
+        partial = df['SITC_Partial'].astype(str) == 'True' if 'SITC_Partial' in df.columns else [False] * len(df)
+        for row_key, code, sitc_description, is_partial in zip(hashes, df['SITC_Code'].astype(str),
+                                                                 df['SITC_Description'].astype(str), partial):
+            if code != 'IDK' and not is_partial:
+                previous[row_key] = {'code': code, 'sitc_description': sitc_description}
+    print(f"Loaded {len(previous)} reusable results from {path}")
+    return previous
+
+
+def classify_with_reuse(descriptions, previous, conn, batch_size=10, label="descriptions", workers=1, known=None,
+                        **classify_options):
+    """Classify only the rows whose hash is not in `previous`, reusing earlier results for the rest
+
+    Result dicts gain `hash` and `reused` keys for the SITC_Hash and
+    SITC_Reused output columns. Rows already resolved in `known` are kept as
+    they are and not counted as reused.
+    """
+    fingerprint = settings_fingerprint(classify_options)
+    hashes = [row_hash(description, fingerprint) for description in descriptions]
+    known = known or [None] * len(descriptions)
+    # Reused rows stay in place, so changed rows get their real neighbours as context
+    known = [dict(resolved, hash=row_key, reused=False) if resolved is not None
+             else dict(previous[row_key], hash=row_key, reused=True) if row_key in previous else None
+             for resolved, row_key in zip(known, hashes)]
+    todo = known.count(None)
+    print(f"Reusing {sum(1 for result in known if result and result['reused'])} of {len(descriptions)} rows; "
+          f"classifying {todo}")
+    if not todo:
+        return known
+
+    results = classify_descriptions(descriptions, conn, batch_size, label, workers, known=known,
+                                    **classify_options)
+    return [result if 'hash' in result else dict(result, hash=row_key, reused=False)
+            for result, row_key in zip(results, hashes)]
+
+
+def classify_rows(descriptions, previous, conn, batch_size=10, label="descriptions", workers=1, known=None,
+                  **classify_options):
+    """Classify descriptions, reusing earlier results for unchanged rows when `previous` is given"""
+    if previous is not None:
+        return classify_with_reuse(descriptions, previous, conn, batch_size, label, workers, known,
+                                   **classify_options)
+    return classify_descriptions(descriptions, conn, batch_size, label, workers, known, **classify_options)
+
+
+def classify_frame(df, col, previous, conn, batch_size=10, label="descriptions", workers=1, concordance=None,
+                   source_col=None, **classify_options):
+    """Classify the rows of a sheet or chunk, resolving rows with a mapped source code by concordance
+
+    Rows whose `source_col` code maps to exactly one SITC code are resolved by
+    a vectorized table lookup; only the rest go to the model, with the rows
+    above them (resolved or not) as recent context. Result dicts
+    gain a `source` key ("concordance" or "model") for the SITC_Source column.
+    """
+    descriptions = df[col].astype(str).tolist()
+    if concordance is None:
+        return classify_rows(descriptions, previous, conn, batch_size, label, workers, **classify_options)
+
+    with stage("concordance"):
+        mapped = concordance.lookup(df[source_col].reset_index(drop=True))
+        resolved = mapped['code'].notna()
+    print(f"Concordance resolved {int(resolved.sum())} of {len(df)} rows "
+          f"({int(mapped['ambiguous'].sum())} ambiguous); {int((~resolved).sum())} left for the model")
+
+    # Resolved rows stay in place as context for the model rows below them
+    known = [{'code': code, 'sitc_description': sitc_description, 'source': 'concordance'} if is_resolved else None
+             for code, sitc_description, is_resolved in zip(mapped['code'], mapped['sitc_description'], resolved)]
+    if resolved.all() and previous is None:
+        return known
+    results = classify_rows(descriptions, previous, conn, batch_size, label, workers, known, **classify_options)
+    return [result if 'source' in result else dict(result, source='model') for result in results]
+
+
+class _Failure:
+    """Carries an exception from the reader thread to the classifying thread"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def pipelined(items, process, write, depth=PIPELINE_DEPTH):
+    """Run read -> process -> write as a pipeline with bounded queues
+
+    `items` is iterated in a reader thread and `write` runs in a writer
+    thread, so reading the next sheet or chunk and writing the last one
+    overlap with `process`, which runs in the calling thread (classification
+    keeps its SQLite connection there). At most `depth` items wait between
+    stages. Results are written in input order. An error in any stage stops
+    the others and is raised here.
+    """
+    read_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    write_errors = []
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_loop():
+        try:
+            for item in items:
+                if not put(read_queue, item):
+                    return
+        except BaseException as e:
+            put(read_queue, _Failure(e))
+            return
+        put(read_queue, _DONE)
+
+    def write_loop():
+        while not stop.is_set():
+            try:
+                item = write_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            try:
+                write(item)
+            except BaseException as e:
+                write_errors.append(e)
+                stop.set()
+                return
+
+    reader = threading.Thread(target=read_loop, name="pipeline-reader", daemon=True)
+    writer = threading.Thread(target=write_loop, name="pipeline-writer", daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            try:
+                item = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    # The writer failed and the reader has given up
+                    break
+                continue
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            if not put(write_queue, process(item)):
+                break
+        put(write_queue, _DONE)
+        writer.join()
+    finally:
+        stop.set()
+        writer.join()
+        reader.join()
+    if write_errors:
+        raise write_errors[0]
+
+
+def may_be_partial(classify_options):
+    """True if a deadline or budget can cut walks short, so the output needs SITC_Partial"""
+    return classify_options.get('deadline') is not None or classify_options.get('budget') is not None
+
+
+def add_result_columns(df, results, flag_partial=False, delta=False, with_source=False):
+    """Add SITC_Code and SITC_Description (and SITC_Partial/SITC_Hash/SITC_Reused/SITC_Source if requested) for row-ordered results"""
+    df['SITC_Code'] = [result['code'] for result in results]
+    df['SITC_Description'] = [result['sitc_description'] for result in results]
+    if flag_partial:
+        # True where the per-item deadline or the budget cut the walk short
+        df['SITC_Partial'] = [result.get('partial', False) for result in results]
+    if delta:
+        df['SITC_Hash'] = [result['hash'] for result in results]
+        df['SITC_Reused'] = [result['reused'] for result in results]
+    if with_source:
+        df['SITC_Source'] = [result['source'] for result in results]
+
+
+def process_excel_file(input_path, output_path=None, batch_size=10, desc_col=None, workers=1, previous=None,
+                       concordance=None, source_col=None, **classify_options):
+    """Process an Excel file and add SITC classifications
+
+    Sheets are read ahead and written out in background threads while the
+    current sheet is classified (see pipelined). With `previous` (the path of
+    an earlier _classified output), only new or changed rows are classified
+    (see classify_with_reuse). With a `concordance`, rows whose `source_col`
+    code has a unique mapping skip the model (see classify_frame).
+    """
     # Handle input/output paths
-    input_path = Path("data") / input_path
+    input_path = resolve_input_path(input_path)
     if output_path is None:
         output_path = input_path.parent / f"{input_path.stem}_classified{input_path.suffix}"
 
     # Read Excel file
     xl = pd.ExcelFile(input_path)
-    output_dict = {}
-    conn = sqlite3.connect("sitc.db")
+    conn = sqlite3.connect(DB_PATH)
+    if previous is not None:
+        previous = load_previous_results(previous, settings_fingerprint(classify_options), desc_col)
 
-    for sheet_name in xl.sheet_names:
-        print(f"\nProcessing sheet: {sheet_name}")
-        df = pd.read_excel(input_path, sheet_name=sheet_name)
+    def read_sheets():
+        for sheet_name in xl.sheet_names:
+            with stage(f"sheet:{sheet_name.replace(';', ',')}"), stage("read"):
+                # Read source codes as text so leading zeros survive where they were stored as text
+                df = xl.parse(sheet_name, dtype={source_col: str} if concordance is not None else None)
 
-        # Find description column
-        desc_col = None
-        for col in ['Description', 'Descriptions']:
-            if col in df.columns:
-                desc_col = col
-                break
+            # Find description column
+            col = find_description_column(df.columns, desc_col)
+            if not col:
+                print(f"No description column found in sheet: {sheet_name}")
+                continue
+            if concordance is not None and source_col not in df.columns:
+                raise ValueError(f"No {source_col} column found in sheet: {sheet_name}")
+            yield sheet_name, df, col
 
-        if not desc_col:
-            print(f"No description column found in sheet: {sheet_name}")
-            continue
+    def classify_sheet(item):
+        sheet_name, df, col = item
+        print(f"\nProcessing sheet: {sheet_name}")
+        with stage(f"sheet:{sheet_name.replace(';', ',')}"), stage("classify"):
+            results = classify_frame(df, col, previous, conn, batch_size, sheet_name, workers, concordance,
+                                     source_col, **classify_options)
+        return sheet_name, df, results
 
+    writer = pd.ExcelWriter(output_path, engine='openpyxl')
+
+    def write_sheet(item):
+        sheet_name, df, results = item
         # Add classification columns
-        df['SITC_Code'] = ''
-        df['SITC_Description'] = ''
+        with stage(f"sheet:{sheet_name.replace(';', ',')}"), stage("write"):
+            add_result_columns(df, results, may_be_partial(classify_options), previous is not None,
+                               concordance is not None)
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
 
-        # Process in batches
-        descriptions = df[desc_col].astype(str).tolist()
-        for i in tqdm(range(0, len(descriptions), batch_size),
-                     desc=f"Processing {sheet_name}",
-                     unit="batch"):
-            batch = descriptions[i:i + batch_size]
-            results = process_batch(batch, conn)
+    try:
+        pipelined(read_sheets(), classify_sheet, write_sheet)
+    finally:
+        conn.close()
 
-            # Update DataFrame with results
-            for j, result in enumerate(results):
-                idx = i + j
-                df.at[idx, 'SITC_Code'] = result['code']
-                df.at[idx, 'SITC_Description'] = result['sitc_description']
+    # Save to Excel
+    with stage("save"):
+        writer.close()
 
-        output_dict[sheet_name] = df
+    return output_path
 
-    conn.close()
 
-    # Save to Excel
-    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-        for sheet_name, df in output_dict.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet support requires pyarrow: pip install pyarrow")
+    return pa, pq
+
+
+def iter_chunks(input_path, columns=None, chunksize=10000):
+    """Yield DataFrame chunks from a CSV or Parquet file without loading it whole"""
+    suffix = input_path.suffix.lower()
+    if suffix == '.csv':
+        # Read everything as text so every chunk has the same column types
+        yield from pd.read_csv(input_path, usecols=columns, chunksize=chunksize,
+                               dtype=str, keep_default_na=False)
+    elif suffix == '.parquet':
+        pa, pq = _import_pyarrow()
+        # Nullable dtypes, so integer columns stay integers in chunks that contain a null
+        nullable = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(),
+                    pa.int64(): pd.Int64Dtype(), pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype(),
+                    pa.uint32(): pd.UInt32Dtype(), pa.uint64(): pd.UInt64Dtype(), pa.bool_(): pd.BooleanDtype()}
+        parquet_file = pq.ParquetFile(input_path)
+        for record_batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield record_batch.to_pandas(types_mapper=nullable.get)
+    else:
+        raise ValueError(f"Unsupported streaming format: {suffix}")
+
+
+def input_arrow_schema(input_path):
+    """Arrow schema of a Parquet input, or None for other formats"""
+    if input_path.suffix.lower() != '.parquet':
+        return None
+    _, pq = _import_pyarrow()
+    return pq.ParquetFile(input_path).schema_arrow
+
+
+class ChunkWriter:
+    """Append classified chunks to a CSV or Parquet file as they are produced
+
+    The Parquet schema comes from the first chunk, except that columns of the
+    input take their type from `input_schema` (the input file's Arrow schema)
+    and other entirely-null columns become strings. A column that happens to
+    be all null in the first chunk therefore still fits later chunks.
+    """
+
+    def __init__(self, output_path, input_schema=None):
+        self.output_path = Path(output_path)
+        self.input_schema = input_schema
+        self.suffix = self.output_path.suffix.lower()
+        if self.suffix not in STREAM_FORMATS:
+            raise ValueError(f"Unsupported output format: {self.suffix}")
+        self.parquet_writer = None
+        self.rows = 0
+
+    def write(self, df):
+        if self.suffix == '.csv':
+            df.to_csv(self.output_path, mode='w' if self.rows == 0 else 'a',
+                      header=self.rows == 0, index=False)
+        else:
+            pa, pq = _import_pyarrow()
+            if self.parquet_writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                fields = []
+                for field in table.schema:
+                    if self.input_schema is not None and field.name in self.input_schema.names:
+                        # Keep the input's types (pandas turns int columns with nulls into floats)
+                        field = field.with_type(self.input_schema.field(field.name).type)
+                    elif pa.types.is_null(field.type):
+                        field = field.with_type(pa.string())
+                    fields.append(field)
+                schema = pa.schema(fields, metadata=table.schema.metadata)
+                table = table.cast(schema)
+                self.parquet_writer = pq.ParquetWriter(self.output_path, schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+
+def process_stream_file(input_path, output_path=None, batch_size=10, desc_col=None,
+                        columns=None, chunksize=10000, workers=1, previous=None, concordance=None,
+                        source_col=None, **classify_options):
+    """Process a CSV or Parquet file chunk by chunk, writing results as each chunk finishes
+
+    With `previous` (the path of an earlier _classified output), only new or
+    changed rows are classified (see classify_with_reuse). With a
+    `concordance`, rows whose `source_col` code has a unique mapping skip the
+    model (see classify_frame).
+    """
+    input_path = resolve_input_path(input_path)
+    if output_path is None:
+        output_path = input_path.parent / f"{input_path.stem}_classified{input_path.suffix}"
+
+    if columns and desc_col and desc_col not in columns:
+        columns = list(columns) + [desc_col]
+    if columns and source_col and source_col not in columns:
+        columns = list(columns) + [source_col]
+
+    if previous is not None:
+        # Read whole before the writer opens, so the previous output may also be the output path
+        previous = load_previous_results(previous, settings_fingerprint(classify_options), desc_col)
+
+    def read_chunks():
+        for chunk_num, df in enumerate(timed_iter(iter_chunks(input_path, columns, chunksize), "read"), 1):
+            col = find_description_column(df.columns, desc_col)
+            if not col:
+                raise ValueError(f"No description column found in {input_path.name}")
+            if concordance is not None and source_col not in df.columns:
+                raise ValueError(f"No {source_col} column found in {input_path.name}")
+            yield chunk_num, df, col
+
+    def classify_chunk(item):
+        chunk_num, df, col = item
+        print(f"\nProcessing chunk {chunk_num} ({len(df)} rows)")
+        with stage("classify"):
+            results = classify_frame(df, col, previous, conn, batch_size, f"chunk {chunk_num}", workers,
+                                     concordance, source_col, **classify_options)
+        return df, results
+
+    def write_chunk(item):
+        df, results = item
+        with stage("write"):
+            add_result_columns(df, results, may_be_partial(classify_options), previous is not None,
+                               concordance is not None)
+            writer.write(df)
+
+    conn = sqlite3.connect(DB_PATH)
+    writer = ChunkWriter(output_path, input_arrow_schema(input_path))
+    try:
+        pipelined(read_chunks(), classify_chunk, write_chunk)
+    finally:
+        writer.close()
+        conn.close()
 
     return output_path
 
+
+def count_input_rows(input_path):
+    """Cheaply count data rows (excluding headers) for the cost projection"""
+    input_path = resolve_input_path(input_path)
+    suffix = input_path.suffix.lower()
+    if suffix == '.csv':
+        with open(input_path, 'rb') as f:
+            return max(sum(1 for _ in f) - 1, 0)
+    if suffix == '.parquet':
+        _, pq = _import_pyarrow()
+        return pq.ParquetFile(input_path).metadata.num_rows
+    xl = pd.ExcelFile(input_path)
+    return sum(max((xl.book[sheet_name].max_row or 1) - 1, 0) for sheet_name in xl.sheet_names)
+
+
+def process_file(input_path, output_path=None, batch_size=10, desc_col=None, columns=None, chunksize=10000,
+                 workers=1, previous=None, concordance=None, source_col=None, **classify_options):
+    """Classify an .xlsx, .csv or .parquet file, choosing the reader from the file extension"""
+    suffix = Path(input_path).suffix.lower()
+    if suffix in STREAM_FORMATS:
+        return process_stream_file(input_path, output_path, batch_size, desc_col, columns, chunksize, workers,
+                                   previous, concordance, source_col, **classify_options)
+    if output_path is not None and Path(output_path).suffix.lower() != '.xlsx':
+        raise ValueError("Excel input can only be written back to .xlsx")
+    return process_excel_file(input_path, output_path, batch_size, desc_col, workers, previous, concordance,
+                              source_col, **classify_options)
+
+
 if __name__ == "__main__":
     # Add command-line argument parsing
-    parser = argparse.ArgumentParser(description='Process Excel file and add SITC classifications')
-    parser.add_argument('input_file', help='Name of the Excel file to process (should be in the data folder)')
+    parser = argparse.ArgumentParser(description='Process an Excel, CSV or Parquet file and add SITC classifications')
+    parser.add_argument('input_file', help='File to process (looked up in the data folder first)')
+    parser.add_argument('--output', help='Output path; .csv or .parquet inputs may be written to either format')
+    parser.add_argument('--desc-col', help='Name of the description column (default: Description/Descriptions)')
+    parser.add_argument('--columns', help='Comma-separated columns to read and carry into the output (CSV/Parquet)')
+    parser.add_argument('--chunksize', type=int, default=10000, help='Rows per chunk when streaming CSV/Parquet')
+    parser.add_argument('--batch-size', type=int, default=10, help='Descriptions per classification batch')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Classify each sheet/chunk as this many parallel shards')
+    parser.add_argument('--budget-tokens', type=int, help='Token budget for the whole run')
+    parser.add_argument('--budget-usd', type=float, help='Dollar budget for the whole run')
+    parser.add_argument('--estimate-only', action='store_true', help='Print the projected cost and exit')
+    parser.add_argument('--record', metavar='PATH', help='Record every model call to a transcript (.jsonl or .jsonl.gz)')
+    parser.add_argument('--replay', metavar='PATH', help='Answer model calls from a recorded transcript instead of the API')
+    parser.add_argument('--replay-latency', default='0',
+                        help='Simulated latency per replayed call in seconds, or "recorded" (default: 0)')
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='PREFIX',
+                        help='Profile the run and write PREFIX.txt/.prof/.folded reports (default prefix: profile)')
+    parser.add_argument('--rules', help='CSV/JSON rule table (pattern, code, type) applied before any model call')
+    parser.add_argument('--flatten-threshold', type=int,
+                        help='Show subtrees with at most this many codes in one prompt and ask for the leaf directly')
+    parser.add_argument('--answer-mode', choices=['letter', 'json'], default='letter',
+                        help='Ask for a lettered option, or for the code as schema-constrained JSON')
+    parser.add_argument('--max-reasks', type=int, default=1,
+                        help='Times to re-ask after an invalid answer before giving up on the attempt')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Answer confident items with the local scorer and escalate disagreements to --strong-model')
+    parser.add_argument('--strong-model', default='gpt-4o',
+                        help='Model making the final decision for escalated items ("none" to keep the default model)')
+    parser.add_argument('--lexical-confidence', type=float, default=0.6,
+                        help='Scorer confidence at which the cascade skips the model entirely')
+    parser.add_argument('--timeout', type=float,
+                        help='Seconds before a model call is abandoned and retried (default: no limit)')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a duplicate request when a call runs past the observed p95 latency')
+    parser.add_argument('--hedge-ratio', type=float, default=0.1, help='Largest share of calls that may be hedged')
+    parser.add_argument('--deadline', type=float,
+                        help='Seconds per item; when they run out, keep the deepest code reached and flag it partial')
+    parser.add_argument('--previous', metavar='PATH',
+                        help='Earlier _classified output; rows whose description and settings are unchanged are reused')
+    parser.add_argument('--source-col', help='Column holding HS or older SITC codes to resolve by concordance')
+    parser.add_argument('--source-system', help='Concordance system of --source-col, as loaded with concordance.py')
     args = parser.parse_args()
+    if bool(args.source_col) != bool(args.source_system):
+        parser.error("--source-col and --source-system must be given together")
+    if args.replay and (args.timeout is not None or args.hedge):
+        parser.error("--timeout and --hedge do not apply to --replay")
+
+    budget = None
+    if args.budget_tokens is not None or args.budget_usd is not None:
+        budget = Budget(max_tokens=args.budget_tokens, max_usd=args.budget_usd)
+
+    conn = sqlite3.connect(DB_PATH)
+    print_cost_projection(conn, count_input_rows(args.input_file), budget=budget)
+    concordance = Concordance(conn, args.source_system) if args.source_system else None
+    conn.close()
+
+    hedged = None
+    if args.timeout is not None or args.hedge:
+        # Hedging sits below recording, so only the winning response is recorded
+        hedged = HedgedLLM(get_llm(), args.timeout, args.hedge, args.hedge_ratio)
+        set_llm(hedged)
+
+    backend = None
+    if args.replay:
+        latency = args.replay_latency if args.replay_latency == 'recorded' else float(args.replay_latency)
+        backend = ReplayLLM(args.replay, latency)
+        set_llm(backend)
+    elif args.record:
+        backend = RecordingLLM(get_llm(), args.record)
+        set_llm(backend)
+
+    cascade = None
+    strong_hedged = None
+    if args.cascade:
+        strong_llm = None
+        if args.strong_model != 'none':
+            # Replayed runs answer the strong model from the same transcript
+            if args.replay:
+                strong_llm = ReplayLLM(latency=backend.latency, shared_with=backend, model_name=args.strong_model)
+            else:
+                strong_llm = chat_model(args.strong_model)
+                if hedged is not None:
+                    strong_hedged = HedgedLLM(strong_llm, args.timeout, args.hedge, args.hedge_ratio)
+                    strong_llm = strong_hedged
+                if args.record:
+                    strong_llm = RecordingLLM(strong_llm, shared_with=backend)
+        cascade = Cascade(strong_llm, args.lexical_confidence)
+
+    if not args.estimate_only:
+        columns = args.columns.split(',') if args.columns else None
+        rules = load_rules(args.rules) if args.rules else None
+        with profile_run(args.profile) if args.profile else nullcontext():
+            output_file = process_file(args.input_file, args.output, args.batch_size, args.desc_col,
+                                       columns, args.chunksize, args.workers, args.previous, concordance,
+                                       args.source_col, budget=budget,
+                                       flatten_threshold=args.flatten_threshold, rules=rules,
+                                       answer_mode=args.answer_mode, max_reasks=args.max_reasks,
+                                       cascade=cascade, deadline=args.deadline)
+        print(f"\nClassification complete. Results saved to: {output_file}")
+        print(usage_stats.summary())
+        if cascade is not None:
+            print(cascade.summary())
+        if budget is not None:
+            print(budget.summary())
+        if hedged is not None:
+            print(hedged.report())
+        if strong_hedged is not None:
+            print(f"Strong model: {strong_hedged.report()}")
+        if backend is not None:
+            print(backend.report())
 
-    output_file = process_excel_file(args.input_file)
-    print(f"\nClassification complete. Results saved to: {output_file}")
+    if isinstance(backend, RecordingLLM):
+        backend.close()
+    if hedged is not None:
+        hedged.close()
+    if strong_hedged is not None:
+        strong_hedged.close()